@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""Long-lived GraphQL client for the Stash API.
+
+One keep-alive connection pool is shared by every thread of the watcher
+container. Operations are registered once by name; requests send the query's
+hash as an automatic persisted query and only fall back to the full query text
+when Stash does not know (or does not support) the hash; a mutation is only
+sent as a hash once persisted queries are known to work. Transient failures are
+retried with exponential backoff and jitter; mutations are only retried when
+the request never reached Stash, a destroy must not run twice.
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import stash_metrics
+
+# (connect, read) timeouts in seconds
+STASH_CONNECT_TIMEOUT = float(os.environ.get("STASH_CONNECT_TIMEOUT", 10))
+STASH_READ_TIMEOUT = float(os.environ.get("STASH_READ_TIMEOUT", 300))
+STASH_RETRIES = int(os.environ.get("STASH_RETRIES", 3))
+STASH_RETRY_BACKOFF = float(os.environ.get("STASH_RETRY_BACKOFF", 1.0))
+STASH_POOL_SIZE = int(os.environ.get("STASH_POOL_SIZE", 10))
+
+RETRY_STATUSES = (502, 503, 504)
+# Errors of a hash-only request that was not executed
+APQ_ERRORS = ("PersistedQueryNotFound", "PersistedQueryNotSupported")
+
+OPERATIONS = {}  # operation name -> (query, sha256, idempotent)
+
+
+def register_operation(name, query, idempotent=None):
+    """Register a named GraphQL operation, returns ``name``.
+
+    Args:
+        idempotent (bool, optional): whether a request that may have reached
+            Stash can be retried. Defaults to True for queries, False for
+            mutations.
+    """
+    if idempotent is None:
+        idempotent = not query.lstrip().startswith("mutation")
+    OPERATIONS[name] = (query, hashlib.sha256(query.encode()).hexdigest(), idempotent)
+    return name
+
+
+def _not_sent(error):
+    """True when ``error`` means the request never reached Stash."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+class GraphQLError(Exception):
+    """GraphQL response carrying ``errors``."""
+
+    def __init__(self, operation, errors):
+        super().__init__(f"{operation}: {errors}")
+        self.operation = operation
+        self.errors = errors
+
+
+class GraphQLClient:
+    """Thread-safe client for registered operations.
+
+    Args:
+        base_url (str): Stash base URL, without /graphql
+        api_key (str): Stash API key
+    """
+
+    def __init__(
+        self,
+        base_url,
+        api_key,
+        timeout=(STASH_CONNECT_TIMEOUT, STASH_READ_TIMEOUT),
+        retries=STASH_RETRIES,
+        pool_size=STASH_POOL_SIZE,
+    ):
+        self.url = base_url.rstrip("/") + "/graphql"
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = False
+        self.session.headers.update(
+            {
+                "content-type": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "ApiKey": api_key,
+            }
+        )
+        self._persisted = set()  # operations Stash has seen the full query of
+        self._apq = True  # cleared once Stash turns out not to support persisted queries
+        self._apq_confirmed = False  # set once a hash-only request succeeded
+        self._lock = threading.Lock()
+
+    def _post(self, payload, idempotent=True):
+        operation = payload.get("operationName")
+        body = json.dumps(payload)
+        for attempt in range(self.retries + 1):
+            stash_metrics.GRAPHQL_BYTES.labels(operation, "sent").inc(len(body))
+            try:
+                response = self.session.post(self.url, data=body, timeout=self.timeout)
+                stash_metrics.GRAPHQL_BYTES.labels(operation, "received").inc(len(response.content))
+                if response.status_code not in RETRY_STATUSES:
+                    response.raise_for_status()
+                    result = response.json()
+                    outcome = "error" if result.get("errors") else "ok"
+                    stash_metrics.GRAPHQL_REQUESTS.labels(operation, outcome).inc()
+                    return result
+                error = requests.HTTPError(f"{response.status_code} from Stash", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            retry = attempt < self.retries and (idempotent or _not_sent(error))
+            stash_metrics.GRAPHQL_REQUESTS.labels(operation, "retry" if retry else "failed").inc()
+            if not retry:
+                raise error
+            time.sleep(STASH_RETRY_BACKOFF * 2**attempt * random.uniform(0.5, 1.5))
+
+    def execute(self, operation, variables=None):
+        """Run a registered operation and return its ``data``.
+
+        Raises:
+            GraphQLError: the response contains errors
+        """
+        query, sha256, idempotent = OPERATIONS[operation]
+        payload = {"operationName": operation, "variables": variables or {}}
+        if self._apq:
+            payload["extensions"] = {"persistedQuery": {"version": 1, "sha256Hash": sha256}}
+        # a failed hash-only mutation can't be resent unless the error says it
+        # never ran, which Stash without APQ support doesn't say
+        hash_only = (
+            self._apq
+            and operation in self._persisted
+            and (idempotent or self._apq_confirmed)
+        )
+        if not hash_only:
+            payload["query"] = query
+
+        result = self._post(payload, idempotent)
+        if hash_only and result.get("errors") and not result.get("data"):
+            messages = [str(error.get("message")) for error in result["errors"]]
+            apq_errors = {name for name in APQ_ERRORS if any(name in m for m in messages)}
+            if apq_errors or idempotent:
+                payload["query"] = query
+                result = self._post(payload, idempotent)
+                if not result.get("errors") and apq_errors != {"PersistedQueryNotFound"}:
+                    # the hash-only request failed for another reason: no APQ support
+                    self._apq = False
+        elif hash_only:
+            self._apq_confirmed = True
+        elif self._apq:
+            with self._lock:
+                self._persisted.add(operation)
+
+        if result.get("errors"):
+            raise GraphQLError(operation, result["errors"])
+        return result["data"]
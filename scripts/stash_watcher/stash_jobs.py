@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+"""Waiting on Stash jobs.
+
+Job status is pushed by Stash's ``jobsSubscribe`` GraphQL subscription over a
+websocket. When the subscription is unavailable (no ``websocket-client``
+package, connection refused, ...) waits fall back to polling ``findJob`` with
+an exponentially growing period.
+"""
+
+import json
+import threading
+import time
+from datetime import datetime
+
+import stashapi.log as log
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+TERMINAL_STATUSES = ("FINISHED", "CANCELLED", "FAILED")
+
+JOBS_SUBSCRIPTION = """
+subscription JobsSubscribe {
+    jobsSubscribe {
+        type
+        job {
+            id
+            status
+            progress
+            description
+            startTime
+            endTime
+        }
+    }
+}
+"""
+
+# Even with a live subscription, re-check the job this often in case an event was missed
+SUBSCRIBED_RECHECK = 60.0
+# Polling fallback starts at the requested period and grows up to this value
+MAX_POLL_PERIOD = 30.0
+# Jobs (pushed by the subscription, or durations) kept, the least recently updated are dropped first
+MAX_TRACKED_JOBS = 256
+
+
+def job_duration(job):
+    """Seconds between the job's startTime and endTime, None when either is unknown."""
+    try:
+        start = datetime.fromisoformat(job["startTime"])
+        end = datetime.fromisoformat(job["endTime"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (end - start).total_seconds()
+
+
+class JobWatcher:
+    """Tracks Stash job status and lets any number of threads wait on jobs.
+
+    Args:
+        stash (StashInterface): used for findJob lookups
+        ws_url (str, optional): websocket URL of Stash's /graphql endpoint
+        api_key (str, optional): Stash API key sent on the websocket handshake
+    """
+
+    def __init__(self, stash, ws_url=None, api_key=None):
+        self.stash = stash
+        self.ws_url = ws_url
+        self.api_key = api_key
+        self.durations = {}  # job_id -> run time in seconds, until popped by the caller
+        self._jobs = {}  # job_id -> latest job pushed by the subscription, oldest first
+        self._cond = threading.Condition()
+        self._connected = False
+        self._thread = None
+
+    @property
+    def subscribed(self):
+        return self._connected
+
+    def start(self):
+        """Start the subscription thread, a no-op when websockets are unavailable."""
+        if self._thread or not self.ws_url or websocket is None:
+            return
+        self._thread = threading.Thread(
+            target=self._subscription_loop, daemon=True, name="JobWatcher"
+        )
+        self._thread.start()
+
+    def _subscription_loop(self):
+        retry = 1.0
+        while True:
+            try:
+                self._subscribe()
+                retry = 1.0
+            except Exception as e:
+                log.debug(f"Job subscription dropped, polling until reconnect: {e}")
+            with self._cond:
+                self._connected = False
+                self._cond.notify_all()
+            time.sleep(retry)
+            retry = min(retry * 2, MAX_POLL_PERIOD)
+
+    def _subscribe(self):
+        header = [f"ApiKey: {self.api_key}"] if self.api_key else []
+        ws = websocket.create_connection(
+            self.ws_url, header=header, subprotocols=["graphql-transport-ws"]
+        )
+        try:
+            ws.send(json.dumps({"type": "connection_init", "payload": {}}))
+            while json.loads(ws.recv()).get("type") != "connection_ack":
+                pass
+            ws.send(
+                json.dumps(
+                    {
+                        "id": "jobs",
+                        "type": "subscribe",
+                        "payload": {"query": JOBS_SUBSCRIPTION},
+                    }
+                )
+            )
+            with self._cond:
+                self._connected = True
+            while True:
+                message = json.loads(ws.recv())
+                kind = message.get("type")
+                if kind == "ping":
+                    ws.send(json.dumps({"type": "pong"}))
+                elif kind == "next":
+                    update = message["payload"]["data"]["jobsSubscribe"]
+                    job = update["job"]
+                    with self._cond:
+                        self._jobs.pop(str(job["id"]), None)
+                        self._jobs[str(job["id"])] = job
+                        # every other Stash job is pushed too, keep only the recent ones
+                        while len(self._jobs) > MAX_TRACKED_JOBS:
+                            del self._jobs[next(iter(self._jobs))]
+                        self._cond.notify_all()
+                elif kind in ("error", "complete"):
+                    raise RuntimeError(f"subscription ended: {message}")
+        finally:
+            ws.close()
+
+    def _poll(self, job_id):
+        job = self.stash.find_job(job_id)
+        if job:
+            with self._cond:
+                self._jobs[job_id] = job
+        return job
+
+    def wait(self, job_id, status="FINISHED", period=1.5, timeout=12000):
+        """Waits for stash job to match desired status
+
+        Args:
+            job_id (ID): the ID of the job to wait for
+            status (str, optional): Desired status to wait for. Defaults to "FINISHED".
+            period (float, optional): Initial polling interval when not subscribed. Defaults to 1.5.
+            timeout (int, optional): time in seconds that if exceeded raises Exception. Defaults to 12000.
+
+        Raises:
+            Exception: timeout raised if wait task takes longer than timeout
+
+        Returns:
+            bool:
+                True: job stats is desired status
+                False: job finished or was cancelled without matching desired status
+                None: job could not be found
+        """
+        job_id = str(job_id)
+        started = time.monotonic()
+        deadline = started + timeout
+        poll_period = period
+        job = self._poll(job_id)
+        while True:
+            if not job:
+                return None
+            if job["status"] == status or job["status"] in TERMINAL_STATUSES:
+                elapsed = job_duration(job)
+                if elapsed is None:
+                    elapsed = time.monotonic() - started
+                with self._cond:
+                    self._jobs.pop(job_id, None)
+                    self.durations[job_id] = elapsed
+                    # callers that never pop their duration don't grow it forever
+                    while len(self.durations) > MAX_TRACKED_JOBS:
+                        del self.durations[next(iter(self.durations))]
+                log.info(f"Job:{job_id} {job['status']} after {elapsed:.1f}s")
+                return job["status"] == status
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise Exception("Hit timeout waiting for Job to complete")
+            with self._cond:
+                if self._connected:
+                    seen = self._jobs.get(job_id)
+                    self._cond.wait_for(
+                        lambda: self._jobs.get(job_id) is not seen or not self._connected,
+                        timeout=min(remaining, SUBSCRIBED_RECHECK),
+                    )
+                    pushed = self._jobs.get(job_id)
+                    # None: dropped from _jobs, look it up below
+                    if pushed is not seen and pushed is not None:
+                        job = pushed
+                        continue
+                else:
+                    self._cond.wait(timeout=min(remaining, poll_period))
+                    poll_period = min(poll_period * 2, MAX_POLL_PERIOD)
+            job = self._poll(job_id)
+            progress = job.get("progress") if job else None
+            log.debug(
+                f"Waiting for Job:{job_id} Status:{job['status'] if job else None} Progress:{progress or 0.0:.1f}"
+            )
+
+    def wait_all(self, job_ids, status="FINISHED", period=1.5, timeout=12000):
+        """Wait for several jobs sharing one deadline.
+
+        Returns:
+            dict: job_id -> result of :meth:`wait`
+        """
+        deadline = time.monotonic() + timeout
+        results = {}
+        for job_id in job_ids:
+            remaining = max(deadline - time.monotonic(), 0)
+            results[job_id] = self.wait(job_id, status, period, remaining)
+        return results
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+"""Prometheus metrics of the watcher container.
+
+Everything is registered on the default registry and served by
+:func:`start_server` on METRICS_PORT. Without the ``prometheus_client``
+package the metrics are no-ops and no endpoint is started.
+"""
+
+import os
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    prometheus_client = None
+
+# Port of the /metrics endpoint, 0 disables it
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9180))
+
+# Stash jobs and worker stages take anywhere from seconds to hours
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 2 * 3600, 6 * 3600)
+
+
+class _NoopMetric:
+    def labels(self, *args, **kwargs):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def time(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _noop_metric(*args, **kwargs):
+    return _NoopMetric()
+
+
+_available = prometheus_client is not None
+_counter = Counter if _available else _noop_metric
+_gauge = Gauge if _available else _noop_metric
+_histogram = Histogram if _available else _noop_metric
+
+EVENTS = _counter(
+    "stash_watcher_events_total",
+    "File events by outcome: received, coalesced into a pending path, dropped as ignored",
+    ["outcome"],
+)
+QUEUE_DEPTH = _gauge("stash_watcher_pending_paths", "Paths waiting in the work queue")
+WORKER_RUNS = _gauge("stash_watcher_worker_runs", "Worker runs in flight or queued", ["state"])
+STAGE_SECONDS = _histogram(
+    "stash_worker_stage_seconds",
+    "Wall time of a worker pipeline stage",
+    ["stage", "outcome"],
+    buckets=DURATION_BUCKETS,
+)
+JOB_SECONDS = _histogram(
+    "stash_worker_job_seconds",
+    "Time spent waiting for a Stash job",
+    ["kind", "status"],
+    buckets=DURATION_BUCKETS,
+)
+GRAPHQL_REQUESTS = _counter(
+    "stash_graphql_requests_total",
+    "GraphQL requests sent to Stash",
+    ["operation", "outcome"],
+)
+GRAPHQL_BYTES = _counter(
+    "stash_graphql_bytes_total",
+    "GraphQL payload bytes exchanged with Stash",
+    ["operation", "direction"],
+)
+AI_QUEUE = _gauge("stash_worker_ai_queue", "Scenes waiting for AI tagging")
+PERMS_SECONDS = _histogram(
+    "stash_watcher_permission_sweep_seconds",
+    "Duration of a fix_permissions sweep",
+    ["full"],
+    buckets=DURATION_BUCKETS,
+)
+
+
+def start_server(port=METRICS_PORT):
+    """Serve /metrics in a background thread, returns False when disabled."""
+    if not _available or not port:
+        return False
+    prometheus_client.start_http_server(port)
+    return True
@@ -0,0 +1,130 @@
+#!/usr/bin/python3
+"""A small DAG scheduler for the stash worker stages.
+
+Each stage declares the stages it depends on. For a single batch, stages whose
+inputs are done run concurrently; across batches, every stage processes one
+batch at a time, so a new batch can be scanned while the previous one is still
+being identified.
+"""
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import stash_metrics
+
+
+class StageSkipped(Exception):
+    """Raised for a stage whose inputs failed."""
+
+
+class Stage:
+    """A named pipeline step.
+
+    Args:
+        name (str): unique stage name
+        func (callable): called with the batch once all inputs are done
+        inputs (tuple, optional): names of the stages this one depends on
+    """
+
+    def __init__(self, name, func, inputs=()):
+        self.name = name
+        self.func = func
+        self.inputs = tuple(inputs)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"Stage({self.name!r}, inputs={self.inputs!r})"
+
+
+class Pipeline:
+    """Runs batches through a DAG of stages.
+
+    Args:
+        stages (list): stages in any order, inputs must name other stages
+        max_batches (int, optional): number of batches that can be in flight
+            before new submissions queue up. Defaults to 2.
+    """
+
+    def __init__(self, stages, max_batches=2):
+        self.stages = self._sort(stages)
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.stages) * max_batches, thread_name_prefix="Stage"
+        )
+
+    @staticmethod
+    def _sort(stages):
+        by_name = {stage.name: stage for stage in stages}
+        ordered, visiting, done = [], set(), set()
+
+        def visit(stage):
+            if stage.name in done:
+                return
+            if stage.name in visiting:
+                raise ValueError(f"Stage cycle through {stage.name}")
+            visiting.add(stage.name)
+            for name in stage.inputs:
+                if name not in by_name:
+                    raise ValueError(f"Stage {stage.name} depends on unknown {name}")
+                visit(by_name[name])
+            visiting.discard(stage.name)
+            done.add(stage.name)
+            ordered.append(stage)
+
+        for stage in stages:
+            visit(stage)
+        return ordered
+
+    @staticmethod
+    def _run_stage(stage, batch, inputs):
+        for name, future in inputs.items():
+            if future.exception() is not None:
+                raise StageSkipped(f"{stage.name} skipped, {name} failed")
+        with stage.lock:
+            started = time.monotonic()
+            outcome = "error"
+            try:
+                result = stage.func(batch)
+                outcome = "ok"
+                return result
+            finally:
+                stash_metrics.STAGE_SECONDS.labels(stage.name, outcome).observe(
+                    time.monotonic() - started
+                )
+
+    def submit(self, batch):
+        """Schedule every stage for ``batch``.
+
+        Tasks are submitted in topological order, so a stage only ever waits on
+        stages that were handed to the executor before it.
+
+        Returns:
+            Future: resolves to a dict of stage name -> result once all stages
+            are done, or to the first stage exception
+        """
+        futures = {}
+        for stage in self.stages:
+            inputs = {name: futures[name] for name in stage.inputs}
+            futures[stage.name] = self._executor.submit(
+                self._run_stage, stage, batch, inputs
+            )
+
+        result = Future()
+        remaining = [len(futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+            for future in futures.values():
+                error = future.exception()
+                if error is not None and not isinstance(error, StageSkipped):
+                    result.set_exception(error)
+                    return
+            result.set_result({name: f.result() for name, f in futures.items()})
+
+        for future in futures.values():
+            future.add_done_callback(on_done)
+        return result
@@ -0,0 +1,329 @@
+#!/usr/bin/python3
+"""Persistent worker state backed by SQLite.
+
+Replaces ``shunned_scenes.json``: scenes that failed to identify are kept with
+a failure count and an exponential retry-after, processed paths remember the
+size/mtime they were processed at, and finished jobs are kept as history.
+Scene deletions are journaled chunk by chunk so an interrupted run resumes.
+Scenes waiting for AI tagging are queued in ``ai_queue``, the ones given up
+after too many attempts are kept in ``ai_gave_up`` and never queued again.
+Small values such as the time of the last full generate live in ``settings``.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+STATE_DB = os.environ.get("WORKER_STATE_DB", "stash_worker.sqlite3")
+# First retry of a shunned scene after this many seconds, doubled on each failure
+SHUN_RETRY_BASE = float(os.environ.get("SHUN_RETRY_BASE", 6 * 3600))
+SHUN_RETRY_MAX = float(os.environ.get("SHUN_RETRY_MAX", 30 * 24 * 3600))
+# Days of job history and of processed path records kept
+JOB_HISTORY_DAYS = float(os.environ.get("JOB_HISTORY_DAYS", 30))
+PROCESSED_PATHS_DAYS = float(os.environ.get("PROCESSED_PATHS_DAYS", 90))
+
+LEGACY_SHUNNED_FILE = "shunned_scenes.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shunned_scenes (
+    scene_id TEXT PRIMARY KEY,
+    failures INTEGER NOT NULL,
+    last_attempt REAL NOT NULL,
+    retry_after REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS shunned_scenes_retry_after ON shunned_scenes (retry_after);
+
+CREATE TABLE IF NOT EXISTS processed_paths (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    processed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS processed_paths_processed_at ON processed_paths (processed_at);
+
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT NOT NULL,
+    kind TEXT,
+    status TEXT,
+    wall_time REAL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at);
+
+CREATE TABLE IF NOT EXISTS deletions (
+    chunk_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    scene_ids TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS deletions_status ON deletions (status);
+
+CREATE TABLE IF NOT EXISTS ai_queue (
+    scene_id TEXT PRIMARY KEY,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    queued_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS ai_gave_up (
+    scene_id TEXT PRIMARY KEY,
+    gave_up_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class StateStore:
+    """Thread-safe access to the worker's SQLite state.
+
+    Args:
+        path (str, optional): database file. Defaults to WORKER_STATE_DB.
+    """
+
+    def __init__(self, path=STATE_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._import_legacy_shunned()
+
+    def _migrate(self):
+        """Add the columns introduced after a table was first created."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(deletions)")}
+        if "attempts" not in columns:
+            self._conn.execute(
+                "ALTER TABLE deletions ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+            )
+
+    def _import_legacy_shunned(self):
+        """Import ``shunned_scenes.json`` once, then rename it out of the way."""
+        if self.get_value("legacy_shunned_imported") or not os.path.isfile(LEGACY_SHUNNED_FILE):
+            return
+        try:
+            with open(LEGACY_SHUNNED_FILE) as f:
+                scene_ids = json.load(f)
+        except (OSError, ValueError):
+            return
+        self.record_identify(scene_ids, scene_ids)
+        self.set_value("legacy_shunned_imported", time.time())
+        try:
+            os.replace(LEGACY_SHUNNED_FILE, LEGACY_SHUNNED_FILE + ".imported")
+        except OSError:
+            pass
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _executemany(self, sql, rows):
+        with self._lock:
+            with self._conn:
+                self._conn.executemany(sql, rows)
+
+    # shunned scenes
+
+    def shunned_ids(self, now=None):
+        """Scene IDs that must not be retried yet."""
+        now = time.time() if now is None else now
+        rows = self._execute(
+            "SELECT scene_id FROM shunned_scenes WHERE retry_after > ?", (now,)
+        )
+        return {row[0] for row in rows}
+
+    def record_identify(self, attempted_ids, failed_ids, now=None):
+        """Shun the failed scenes with exponential backoff and forgive the rest."""
+        now = time.time() if now is None else now
+        failed = {str(scene_id) for scene_id in failed_ids}
+        succeeded = [
+            (str(scene_id),)
+            for scene_id in attempted_ids
+            if str(scene_id) not in failed
+        ]
+        self._executemany("DELETE FROM shunned_scenes WHERE scene_id = ?", succeeded)
+        self._executemany(
+            """
+            INSERT INTO shunned_scenes (scene_id, failures, last_attempt, retry_after)
+            VALUES (?1, 1, ?2, ?2 + ?3)
+            ON CONFLICT (scene_id) DO UPDATE SET
+                failures = failures + 1,
+                last_attempt = ?2,
+                retry_after = ?2 + min(?3 * (1 << failures), ?4)
+            """,
+            [(scene_id, now, SHUN_RETRY_BASE, SHUN_RETRY_MAX) for scene_id in failed],
+        )
+
+    # processed paths
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None, None
+        return st.st_size, st.st_mtime_ns
+
+    def unprocessed(self, paths):
+        """Filter out files already processed at their current size and mtime."""
+        result = []
+        for path in paths:
+            if os.path.isdir(path):
+                result.append(path)
+                continue
+            rows = self._execute(
+                "SELECT size, mtime_ns FROM processed_paths WHERE path = ?", (path,)
+            )
+            if not rows or tuple(rows[0]) != self._signature(path):
+                result.append(path)
+        return result
+
+    def mark_processed(self, paths, now=None):
+        now = time.time() if now is None else now
+        self._executemany(
+            "INSERT OR REPLACE INTO processed_paths VALUES (?, ?, ?, ?)",
+            [(path, *self._signature(path), now) for path in paths],
+        )
+        # an expired record only costs a rescan of the file
+        self._execute(
+            "DELETE FROM processed_paths WHERE processed_at < ?",
+            (now - PROCESSED_PATHS_DAYS * 24 * 3600,),
+        )
+
+    # jobs
+
+    def record_job(self, job_id, kind, status, wall_time, now=None):
+        now = time.time() if now is None else now
+        self._execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, ?)",
+            (str(job_id), kind, status, wall_time, now),
+        )
+        self._execute(
+            "DELETE FROM jobs WHERE finished_at < ?", (now - JOB_HISTORY_DAYS * 24 * 3600,)
+        )
+
+    def job_history(self, limit=50):
+        """Most recent jobs first, as (job_id, kind, status, wall_time, finished_at)."""
+        return self._execute(
+            "SELECT * FROM jobs ORDER BY finished_at DESC LIMIT ?", (limit,)
+        )
+
+    # deletion journal
+
+    def journal_deletions(self, chunks, now=None):
+        """Journal chunks of (scene_ids, bytes) as pending before any is executed."""
+        now = time.time() if now is None else now
+        self._executemany(
+            "INSERT INTO deletions (scene_ids, bytes, status, created_at) VALUES (?, ?, 'pending', ?)",
+            [(json.dumps(list(ids)), int(nbytes), now) for ids, nbytes in chunks],
+        )
+
+    def pending_deletions(self):
+        """Pending chunks in journal order, as (chunk_id, scene_ids, bytes)."""
+        rows = self._execute(
+            "SELECT chunk_id, scene_ids, bytes FROM deletions WHERE status = 'pending' ORDER BY chunk_id"
+        )
+        return [(chunk_id, json.loads(ids), nbytes) for chunk_id, ids, nbytes in rows]
+
+    def pending_deletion_ids(self):
+        """Scene IDs of the pending chunks."""
+        rows = self._execute("SELECT scene_ids FROM deletions WHERE status = 'pending'")
+        return {str(scene_id) for (ids,) in rows for scene_id in json.loads(ids)}
+
+    def retry_deletion(self, chunk_id, max_attempts, now=None):
+        """Count a failed attempt, returns True once the chunk is marked failed."""
+        now = time.time() if now is None else now
+        self._execute(
+            """
+            UPDATE deletions SET
+                attempts = attempts + 1,
+                status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END,
+                finished_at = CASE WHEN attempts + 1 >= ? THEN ? ELSE finished_at END
+            WHERE chunk_id = ?
+            """,
+            (max_attempts, max_attempts, now, chunk_id),
+        )
+        rows = self._execute("SELECT status FROM deletions WHERE chunk_id = ?", (chunk_id,))
+        return bool(rows) and rows[0][0] == "failed"
+
+    def finish_deletion(self, chunk_id, status="done", now=None):
+        now = time.time() if now is None else now
+        self._execute(
+            "UPDATE deletions SET status = ?, finished_at = ? WHERE chunk_id = ?",
+            (status, now, chunk_id),
+        )
+
+    # AI tagging queue
+
+    def enqueue_ai(self, scene_ids, now=None):
+        """Queue scenes for AI tagging, returns the number of newly queued scenes.
+
+        Scenes given up on earlier are not queued again.
+        """
+        now = time.time() if now is None else now
+        before = self.ai_backlog()
+        self._executemany(
+            "INSERT OR IGNORE INTO ai_queue (scene_id, queued_at) SELECT ?, ?"
+            " WHERE NOT EXISTS (SELECT 1 FROM ai_gave_up WHERE scene_id = ?)",
+            [(str(scene_id), now, str(scene_id)) for scene_id in scene_ids],
+        )
+        return self.ai_backlog() - before
+
+    def ai_backlog(self):
+        return self._execute("SELECT COUNT(*) FROM ai_queue")[0][0]
+
+    def next_ai_batch(self, limit):
+        """Oldest queued scene IDs, scenes retried the fewest times first."""
+        rows = self._execute(
+            "SELECT scene_id FROM ai_queue ORDER BY attempts, queued_at LIMIT ?", (limit,)
+        )
+        return [row[0] for row in rows]
+
+    def dequeue_ai(self, scene_ids):
+        self._executemany(
+            "DELETE FROM ai_queue WHERE scene_id = ?", [(str(i),) for i in scene_ids]
+        )
+
+    def finish_ai(self, done_ids, pending_ids, max_attempts, now=None):
+        """Dequeue tagged scenes and count an attempt for the others.
+
+        Returns:
+            list: pending scene IDs given up after ``max_attempts`` attempts
+        """
+        now = time.time() if now is None else now
+        pending = [(str(scene_id),) for scene_id in pending_ids]
+        self.dequeue_ai(done_ids)
+        self._executemany(
+            "UPDATE ai_queue SET attempts = attempts + 1 WHERE scene_id = ?", pending
+        )
+        dropped = [
+            row[0]
+            for row in self._execute(
+                "SELECT scene_id FROM ai_queue WHERE attempts >= ?", (max_attempts,)
+            )
+        ]
+        self._executemany(
+            "INSERT OR REPLACE INTO ai_gave_up (scene_id, gave_up_at) VALUES (?, ?)",
+            [(scene_id, now) for scene_id in dropped],
+        )
+        self.dequeue_ai(dropped)
+        return dropped
+
+    # settings
+
+    def get_value(self, key, default=None):
+        rows = self._execute("SELECT value FROM settings WHERE key = ?", (key,))
+        return rows[0][0] if rows else default
+
+    def set_value(self, key, value):
+        self._execute(
+            "INSERT OR REPLACE INTO settings VALUES (?, ?)", (key, str(value))
+        )
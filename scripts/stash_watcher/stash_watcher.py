@@ -1,6 +1,8 @@
 #!/usr/bin/python3
 import builtins
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
+import json
 import os
 import stat
 import time
@@ -17,23 +19,57 @@ def print(*args, **kwargs):
 
 try:
     from watchdog.events import FileSystemEvent, FileSystemEventHandler
-    from watchdog.observers.polling import PollingObserver as Observer
+    from watchdog.observers import Observer as NativeObserver
+    from watchdog.observers.polling import PollingObserver
     import stash_worker
 except Exception:
     subprocess.check_call([sys.executable, "-m", "pip", "install", "watchdog"])
     from watchdog.events import FileSystemEvent, FileSystemEventHandler
-    from watchdog.observers.polling import PollingObserver as Observer
+    from watchdog.observers import Observer as NativeObserver
+    from watchdog.observers.polling import PollingObserver
     import stash_worker
+import stash_metrics
 
 
 # Poll interval in seconds (default: 30 minutes)
 POLL_INTERVAL = int(os.environ.get("POLL_INTERVAL", 30 * 60))
+# Bounds of the adaptive poll interval: it doubles while the library is idle
+# and shrinks towards the minimum after bursts of events
+POLL_MIN_INTERVAL = int(os.environ.get("POLL_MIN_INTERVAL", 5 * 60))
+POLL_MAX_INTERVAL = int(os.environ.get("POLL_MAX_INTERVAL", 6 * 3600))
+# Number of file events since the last pass that counts as a burst
+POLL_BURST_EVENTS = int(os.environ.get("POLL_BURST_EVENTS", 100))
+# Quiet window in seconds: pending paths are flushed once no new event arrived for this long
+DEBOUNCE_SECONDS = float(os.environ.get("DEBOUNCE_SECONDS", 30))
+# Upper bound in seconds on how long a steady stream of events can delay a flush
+DEBOUNCE_MAX_WAIT = float(os.environ.get("DEBOUNCE_MAX_WAIT", 10 * 60))
+# Observer used for the library paths: "auto" (inotify unless the mount is known
+# not to deliver events), "inotify" or "polling"
+WATCH_OBSERVER = os.environ.get("WATCH_OBSERVER", "auto").lower()
+# Filesystems on which inotify misses changes made by other hosts/processes
+POLLING_FSTYPES = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "fuse", "fuseblk", "sshfs")
+# Reconciliation scan interval in seconds, catches events the observers missed
+RECONCILE_INTERVAL = int(os.environ.get("RECONCILE_INTERVAL", 6 * 3600))
+RECONCILE_SNAPSHOT_FILE = os.environ.get("RECONCILE_SNAPSHOT_FILE", "reconcile_snapshot.json")
+# A file is only handed to the worker once its size/mtime did not change for this long
+STABLE_SECONDS = float(os.environ.get("STABLE_SECONDS", 60))
+# Staging directories and temp extensions used by download clients, never handed to the worker
+IGNORED_DIRS = os.environ.get("IGNORED_DIRS", ".downloading,.torrents").split(",")
+IGNORED_EXTENSIONS = os.environ.get(
+    "IGNORED_EXTENSIONS", ".part,.partial,.!qb,.!ut,.tmp,.crdownload,.parts"
+).lower().split(",")
 DATA_ROOT = os.getenv("DATA_ROOT")
 TARGET_UID = int(os.environ.get("FIX_PERMS_UID", 1000))
 TARGET_GID = int(os.environ.get("FIX_PERMS_GID", 1000))
 
 # Directories to fix permissions on
 PERMS_DIRS = ["/provision", "/data/torrents-stash"]
+# Directory mtime/inode cache that lets fix_permissions skip unchanged directories
+PERMS_CACHE_FILE = os.environ.get("PERMS_CACHE_FILE", "perms_cache.json")
+# Every Nth pass ignores the cache (catches chmod/chown done by other containers)
+PERMS_FULL_SWEEP_EVERY = max(int(os.environ.get("PERMS_FULL_SWEEP_EVERY", 48)), 1)
+# Threads used to apply chown/chmod, 1 applies them inline
+PERMS_WORKERS = int(os.environ.get("PERMS_WORKERS", 4))
 
 if DATA_ROOT:
     (Path(DATA_ROOT) / "torrents-stash/.downloading/").mkdir(parents=True, exist_ok=True)
@@ -42,100 +78,638 @@ if DATA_ROOT:
     (Path(DATA_ROOT) / "torrents-stash/whisparr/").mkdir(parents=True, exist_ok=True)
 
 
-def fix_permissions(dirs=PERMS_DIRS):
+def _load_perms_cache():
+    try:
+        with open(PERMS_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"passes": 0, "dirs": {}}
+
+
+def _save_perms_cache(cache):
+    tmp = PERMS_CACHE_FILE + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp, PERMS_CACHE_FILE)
+    except OSError as e:
+        print(f"[PermFix] Failed to save cache {PERMS_CACHE_FILE}: {e}")
+
+
+def _needed_fix(path, st, mode):
+    """Return (path, chown?, chmod mode or None) or None when nothing is needed."""
+    needs_chown = st.st_uid != TARGET_UID or st.st_gid != TARGET_GID
+    needs_chmod = (st.st_mode & 0o7777) != mode
+    if needs_chown or needs_chmod:
+        return path, needs_chown, mode if needs_chmod else None
+    return None
+
+
+def _apply_fix(fix):
+    path, needs_chown, mode = fix
+    fixed = 0
+    if needs_chown:
+        os.chown(path, TARGET_UID, TARGET_GID)
+        fixed += 1
+    if mode is not None:
+        os.chmod(path, mode)
+        fixed += 1
+    return fixed
+
+
+def fix_permissions(dirs=PERMS_DIRS, full=False):
     """Fix ownership and permissions so all containers (UID 1000) can access files.
 
     - chown everything to TARGET_UID:TARGET_GID
     - dirs: 2775 (rwxrwsr-x, setgid so new files inherit group)
     - files: 0664 (rw-rw-r--)
     Requires CAP_CHOWN, CAP_FOWNER, CAP_DAC_OVERRIDE.
+
+    Each directory's mtime/inode is remembered in PERMS_CACHE_FILE; a directory
+    whose entries did not change since the previous pass is not listed again
+    and its files are not stat'ed, only its known subdirectories are visited.
+    Every PERMS_FULL_SWEEP_EVERY passes (or with ``full``) everything is checked.
+    A directory is only cached once every fix inside it succeeded.
     """
-    fixed = 0
+    started = time.monotonic()
+    cache = _load_perms_cache()
+    full = full or cache["passes"] % PERMS_FULL_SWEEP_EVERY == 0
+    old_dirs, new_dirs = cache["dirs"], {}
+    fixes = []  # (fix, directory listing the fixed path)
     errors = 0
+    skipped = 0
+
+    def report(kind, path, e):
+        nonlocal errors
+        errors += 1
+        if errors <= 5:
+            print(f"[PermFix] Error on {kind} {path}: {e}")
+
     for root_dir in dirs:
         if not os.path.exists(root_dir):
             continue
-        for dirpath, dirnames, filenames in os.walk(root_dir):
+        stack = [root_dir]
+        while stack:
+            dirpath = stack.pop()
             # Fix directory
             try:
                 st = os.stat(dirpath)
-                needs_chown = st.st_uid != TARGET_UID or st.st_gid != TARGET_GID
-                # 2775 = rwxrwsr-x (setgid)
-                needs_chmod = (st.st_mode & 0o7777) != 0o2775
-                if needs_chown:
-                    os.chown(dirpath, TARGET_UID, TARGET_GID)
-                    fixed += 1
-                if needs_chmod:
-                    os.chmod(dirpath, 0o2775)
-                    fixed += 1
             except OSError as e:
-                errors += 1
-                if errors <= 5:
-                    print(f"[PermFix] Error on dir {dirpath}: {e}")
+                report("dir", dirpath, e)
+                continue
+            fix = _needed_fix(dirpath, st, 0o2775)
+            if fix:
+                fixes.append((fix, dirpath))
+
+            key = [st.st_mtime_ns, st.st_ino]
+            cached = old_dirs.get(dirpath)
+            if not full and cached and cached[:2] == key:
+                skipped += 1
+                new_dirs[dirpath] = cached
+                stack.extend(os.path.join(dirpath, name) for name in cached[2])
+                continue
+
+            # Fix files, scandir entries carry the file type so only files get an lstat
+            subdirs = []
+            complete = True
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                subdirs.append(entry.name)
+                                continue
+                            if entry.is_symlink():
+                                continue
+                            fix = _needed_fix(
+                                entry.path, entry.stat(follow_symlinks=False), 0o0664
+                            )
+                            if fix:
+                                fixes.append((fix, dirpath))
+                        except OSError as e:
+                            report("file", entry.path, e)
+                            complete = False
+            except OSError as e:
+                report("dir", dirpath, e)
+                continue
+            if complete:
+                new_dirs[dirpath] = key + [subdirs]
+            stack.extend(os.path.join(dirpath, name) for name in subdirs)
 
-            # Fix files
-            for fname in filenames:
-                fpath = os.path.join(dirpath, fname)
+    fixed = 0
+    failed_dirs = set()
+    if PERMS_WORKERS > 1 and len(fixes) > 1:
+        with ThreadPoolExecutor(PERMS_WORKERS, thread_name_prefix="PermFix") as pool:
+            futures = {pool.submit(_apply_fix, fix): (fix[0], d) for fix, d in fixes}
+            for future, (path, dirpath) in futures.items():
                 try:
-                    st = os.lstat(fpath)
-                    if stat.S_ISLNK(st.st_mode):
-                        continue
-                    needs_chown = st.st_uid != TARGET_UID or st.st_gid != TARGET_GID
-                    # 0664 = rw-rw-r--
-                    needs_chmod = (st.st_mode & 0o7777) != 0o0664
-                    if needs_chown:
-                        os.chown(fpath, TARGET_UID, TARGET_GID)
-                        fixed += 1
-                    if needs_chmod:
-                        os.chmod(fpath, 0o0664)
-                        fixed += 1
+                    fixed += future.result()
                 except OSError as e:
-                    errors += 1
-                    if errors <= 5:
-                        print(f"[PermFix] Error on file {fpath}: {e}")
-
+                    report("path", path, e)
+                    failed_dirs.add(dirpath)
+    else:
+        for fix, dirpath in fixes:
+            try:
+                fixed += _apply_fix(fix)
+            except OSError as e:
+                report("path", fix[0], e)
+                failed_dirs.add(dirpath)
+    # listed again next pass so the failed fixes are retried
+    for dirpath in failed_dirs:
+        new_dirs.pop(dirpath, None)
+
+    _save_perms_cache({"passes": cache["passes"] + 1, "dirs": new_dirs})
+    elapsed = time.monotonic() - started
+    stash_metrics.PERMS_SECONDS.labels(full=str(full).lower()).observe(elapsed)
+    sweep = "full" if full else f"incremental, {skipped} unchanged dirs skipped"
     if fixed > 0 or errors > 0:
-        print(f"[PermFix] Done: {fixed} fixes applied, {errors} errors")
+        print(f"[PermFix] Done ({sweep}, {elapsed:.1f}s): {fixed} fixes applied, {errors} errors")
     else:
-        print(f"[PermFix] All permissions OK")
+        print(f"[PermFix] All permissions OK ({sweep}, {elapsed:.1f}s)")
+
+
+class WorkerRuns:
+    """Single-flight access to the stash worker.
+
+    At most one worker run is in flight. Paths requested meanwhile are merged
+    into the next run, a whole-library request (``paths=None``) absorbs any
+    path set, so a burst of events and a scheduled pass never submit
+    duplicate scan/identify/generate jobs to Stash. This also means the
+    worker's cross-batch pipelining (PIPELINE_MAX_BATCHES) is not used here.
+
+    ``stash_worker.submit`` can block on the worker lock and talks to Stash, so
+    it is always called without holding ``_lock``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._running = False
+        self._next = None  # [merged paths or None for the whole library, Future]
+
+    @property
+    def busy(self):
+        with self._lock:
+            return self._running or self._next is not None
+
+    def request(self, paths=None):
+        """Run the worker on ``paths`` (the whole library if None) as soon as possible.
+
+        Returns:
+            Future: resolves with the result of the run that covered ``paths``
+        """
+        with self._lock:
+            if self._next is None:
+                self._next = [set(), Future()]
+            if paths is None:
+                self._next[0] = None
+            elif self._next[0] is not None:
+                self._next[0].update(str(path) for path in paths)
+            future = self._next[1]
+            claimed = self._claim()
+            self._report_gauges()
+        if claimed:
+            self._launch(*claimed)
+        return future
+
+    def _report_gauges(self):
+        stash_metrics.WORKER_RUNS.labels(state="running").set(int(self._running))
+        stash_metrics.WORKER_RUNS.labels(state="queued").set(int(self._next is not None))
+
+    def _claim(self):
+        """Take the merged run if none is in flight, called with the lock held."""
+        if self._running or self._next is None:
+            return None
+        claimed, self._next = self._next, None
+        self._running = True
+        return claimed
+
+    def _launch(self, paths, future):
+        """Submit a claimed run, called without the lock."""
+        try:
+            run = stash_worker.submit(sorted(paths) if paths is not None else None)
+        except Exception as e:
+            future.set_exception(e)
+            self._release()
+            return
+        run.add_done_callback(lambda done: self._finished(done, future))
+
+    def _finished(self, done, future):
+        error = done.exception()
+        if error is None:
+            future.set_result(done.result())
+        else:
+            future.set_exception(error)
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._running = False
+            claimed = self._claim()
+            self._report_gauges()
+        if claimed:
+            self._launch(*claimed)
 
 
 class BackgroundPoller(threading.Thread):
-    """Background thread that periodically runs the stash worker and fixes permissions."""
+    """Background thread that periodically runs the stash worker and fixes permissions.
+
+    A pass is skipped when neither file events nor changes in Stash were seen
+    since the last successful one, or while event-driven runs are still
+    queued or in flight. Idle skips double the interval up to ``max_interval``;
+    a burst of events halves it down to ``min_interval``.
+    """
 
-    def __init__(self, interval: int = POLL_INTERVAL):
+    def __init__(
+        self,
+        queue,
+        runs,
+        interval: int = POLL_INTERVAL,
+        min_interval: int = POLL_MIN_INTERVAL,
+        max_interval: int = POLL_MAX_INTERVAL,
+        burst_events: int = POLL_BURST_EVENTS,
+        on_tick=None,
+    ):
         super().__init__(daemon=True, name="BackgroundPoller")
+        self.queue = queue
+        self.runs = runs
         self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval, interval)
+        self.burst_events = burst_events
+        # called before every scheduled pass, e.g. to pick up new library paths
+        self.on_tick = on_tick
+        self._events_at_pass = None
+        self._fingerprint_at_pass = None
         self._stop_event = threading.Event()
 
     def stop(self):
         self._stop_event.set()
 
+    @staticmethod
+    def _fingerprint():
+        try:
+            return stash_worker.library_fingerprint()
+        except Exception as e:
+            print(f"[BackgroundPoller] Could not fetch library fingerprint: {e}")
+            return None
+
+    def _next_interval(self, interval):
+        """Return (run, interval): whether a pass is due and the wait before the next tick."""
+        if self.queue.busy or self.runs.busy:
+            print("[BackgroundPoller] Worker run in flight, skipping this pass")
+            return False, self.min_interval
+        seen = self.queue.events - (self._events_at_pass or 0)
+        if self._events_at_pass is not None and not seen:
+            fingerprint = self._fingerprint()
+            if fingerprint is not None and fingerprint == self._fingerprint_at_pass:
+                interval = min(interval * 2, self.max_interval)
+                print(f"[BackgroundPoller] Library idle, skipping this pass, next check in {interval}s")
+                return False, interval
+        if seen >= self.burst_events:
+            return True, max(interval // 2, self.min_interval)
+        return True, self.interval
+
     def run(self):
-        print(f"Background poller started, will run every {self.interval} seconds")
+        print(
+            f"Background poller started, will run every {self.interval} seconds "
+            f"(adaptive between {self.min_interval} and {self.max_interval})"
+        )
+        interval = self.interval
         while not self._stop_event.is_set():
             # Wait for the interval (or until stopped)
-            if self._stop_event.wait(timeout=self.interval):
+            if self._stop_event.wait(timeout=interval):
                 break
+            if self.on_tick:
+                try:
+                    self.on_tick()
+                except Exception as e:
+                    print(f"[BackgroundPoller] Error in tick hook: {e}")
+                    print(traceback.format_exc())
+            due, interval = self._next_interval(interval)
+            if not due:
+                continue
+            events = self.queue.events
             try:
                 print(f"[BackgroundPoller] Running scheduled scan at {time.strftime('%Y-%m-%d %H:%M:%S')}")
                 fix_permissions()
-                stash_worker.main()
+                self.runs.request().result()
                 print(f"[BackgroundPoller] Scheduled scan completed at {time.strftime('%Y-%m-%d %H:%M:%S')}")
             except Exception as e:
                 print(f"[BackgroundPoller] Error during scheduled scan: {e}")
                 print(traceback.format_exc())
+                continue
+            # taken after the pass, which itself updates scenes in Stash
+            self._events_at_pass = events
+            self._fingerprint_at_pass = self._fingerprint()
+
+
+def is_ignored(path):
+    """True for download-client staging paths and temp files."""
+    parts = Path(path).parts
+    if any(part in IGNORED_DIRS for part in parts):
+        return True
+    return path.lower().endswith(tuple(ext for ext in IGNORED_EXTENSIONS if ext))
+
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+class PendingPath:
+    """Event bookkeeping for one path waiting in the WorkQueue."""
+
+    def __init__(self, now):
+        self.first_event = now
+        self.signature = None
+        self.stable_since = now
+        self.closed = False
+
+
+class WorkQueue(threading.Thread):
+    """Coalesces file events into batched stash worker runs.
+
+    Paths are collected into a pending set and flushed as a single
+    worker run request once no new event arrived for
+    ``quiet`` seconds (or ``max_wait`` seconds after the first pending event).
+    Only paths that are done being written are flushed: a path is released on
+    close-write, or once its size/mtime did not change for ``stable`` seconds;
+    the others stay pending.
+    The observer thread only ever touches the pending set, never Stash.
+    """
+
+    def __init__(
+        self,
+        runs,
+        quiet: float = DEBOUNCE_SECONDS,
+        max_wait: float = DEBOUNCE_MAX_WAIT,
+        stable: float = STABLE_SECONDS,
+    ):
+        super().__init__(daemon=True, name="WorkQueue")
+        self.runs = runs
+        self.quiet = quiet
+        self.max_wait = max_wait
+        self.stable = stable
+        self._pending = {}  # path -> PendingPath
+        self._last_event = 0.0
+        self._in_flight = 0
+        self.events = 0  # total events seen, read by the BackgroundPoller
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+
+    def submit(self, path, closed=False):
+        """Queue ``path``; ``closed`` marks a close-write, i.e. the file is complete."""
+        with self._cond:
+            now = time.monotonic()
+            stash_metrics.EVENTS.labels(outcome="received").inc()
+            if path in self._pending:
+                stash_metrics.EVENTS.labels(outcome="coalesced").inc()
+            entry = self._pending.setdefault(path, PendingPath(now))
+            stash_metrics.QUEUE_DEPTH.set(len(self._pending))
+            if closed:
+                entry.closed = True
+                entry.signature = file_signature(path)
+            self._last_event = now
+            self.events += 1
+            self._cond.notify()
+
+    @property
+    def busy(self):
+        """True while paths are pending or a flushed batch is still running."""
+        with self._cond:
+            return bool(self._pending) or self._in_flight > 0
+
+    def _is_stable(self, path, entry, now):
+        """Update the stability bookkeeping of ``path`` and return the seconds left, 0 when stable."""
+        signature = file_signature(path)
+        if signature != entry.signature:
+            entry.signature = signature
+            entry.stable_since = now
+            entry.closed = False
+        # a vanished file is released right away so Stash drops it
+        if entry.closed or signature is None:
+            return 0
+        return max(entry.stable_since + self.stable - now, 0)
+
+    def stop(self):
+        self._stop_event.set()
+        with self._cond:
+            self._cond.notify()
+
+    def _take_ready(self):
+        """Return the pending paths if the batch is due, otherwise None and the time to wait."""
+        if not self._pending:
+            return None, None
+        now = time.monotonic()
+        quiet_left = self._last_event + self.quiet - now
+        first_event = min(entry.first_event for entry in self._pending.values())
+        max_left = first_event + self.max_wait - now
+        wait = min(quiet_left, max_left)
+        if wait > 0:
+            return None, wait
+        ready, wait = [], None
+        for path, entry in self._pending.items():
+            left = self._is_stable(path, entry, now)
+            if left:
+                wait = left if wait is None else min(wait, left)
+            else:
+                ready.append(path)
+        if not ready:
+            return None, wait
+        for path in ready:
+            del self._pending[path]
+        stash_metrics.QUEUE_DEPTH.set(len(self._pending))
+        return sorted(ready), None
+
+    def run(self):
+        print(f"Work queue started, quiet window {self.quiet}s, max wait {self.max_wait}s")
+        while not self._stop_event.is_set():
+            with self._cond:
+                paths, wait = self._take_ready()
+                if paths is None:
+                    self._cond.wait(timeout=wait)
+                    continue
+                self._in_flight += 1
+            try:
+                print(f"[WorkQueue] Flushing {len(paths)} coalesced path(s)")
+                # don't wait: paths arriving meanwhile are merged into the next run
+                self.runs.request(paths).add_done_callback(self._report)
+            except Exception as e:
+                self._done()
+                print(f"[WorkQueue] Error submitting worker run: {e}")
+                print(traceback.format_exc())
+
+    def _done(self):
+        with self._cond:
+            self._in_flight -= 1
+
+    def _report(self, future):
+        self._done()
+        error = future.exception()
+        if error is not None:
+            print(f"[WorkQueue] Error during worker run: {error}")
+            print("".join(traceback.format_exception(error)))
+
+
+def mount_fstype(path):
+    """Filesystem type of the mount containing ``path``, from /proc/mounts."""
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = fields[1].replace("\\040", " ")
+                inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) > len(best):
+                    best, fstype = mount_point, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+def observer_kind(path):
+    """Pick "inotify" or "polling" for a watched directory according to WATCH_OBSERVER."""
+    if WATCH_OBSERVER in ("inotify", "polling"):
+        return WATCH_OBSERVER
+    fstype = mount_fstype(path) or ""
+    if fstype in POLLING_FSTYPES or fstype.startswith("fuse."):
+        return "polling"
+    return "inotify"
+
+
+class Reconciler(threading.Thread):
+    """Periodically diffs the watched trees against a persisted snapshot.
+
+    New or changed files are submitted to the work queue, covering events the
+    observers dropped (inotify queue overflow, container restarts, ...). Like
+    fix_permissions, directories whose mtime is unchanged reuse their snapshot
+    entries instead of being listed and stat'ed again.
+
+    A directory's mtime only changes when entries are created, renamed or
+    removed, so a file rewritten in place (same name, no rename) is never seen
+    here; those changes rely on the observers alone.
+    """
+
+    def __init__(self, queue, directories, interval: int = RECONCILE_INTERVAL):
+        super().__init__(daemon=True, name="Reconciler")
+        self.queue = queue
+        self.directories = list(directories)
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    @staticmethod
+    def _load():
+        try:
+            with open(RECONCILE_SNAPSHOT_FILE) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _save(snapshot):
+        tmp = RECONCILE_SNAPSHOT_FILE + ".tmp"
+        try:
+            with open(tmp, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp, RECONCILE_SNAPSHOT_FILE)
+        except OSError as e:
+            print(f"[Reconciler] Failed to save snapshot: {e}")
+
+    def scan(self, old):
+        """Return the new snapshot and the files that are new or changed since ``old``."""
+        snapshot, changed = {}, []
+        for root_dir in self.directories:
+            stack = [root_dir]
+            while stack:
+                dirpath = stack.pop()
+                try:
+                    mtime = os.stat(dirpath).st_mtime_ns
+                except OSError:
+                    continue
+                cached = old.get(dirpath)
+                if cached and cached["mtime"] == mtime:
+                    snapshot[dirpath] = cached
+                    stack.extend(os.path.join(dirpath, name) for name in cached["dirs"])
+                    continue
+                files, subdirs = {}, []
+                try:
+                    with os.scandir(dirpath) as entries:
+                        for entry in entries:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    subdirs.append(entry.name)
+                                elif entry.is_file(follow_symlinks=False):
+                                    st = entry.stat(follow_symlinks=False)
+                                    files[entry.name] = [st.st_size, st.st_mtime_ns]
+                            except OSError:
+                                continue
+                except OSError:
+                    continue
+                known = cached["files"] if cached else {}
+                changed += [
+                    os.path.join(dirpath, name)
+                    for name, sig in files.items()
+                    if known.get(name) != sig
+                ]
+                snapshot[dirpath] = {"mtime": mtime, "dirs": subdirs, "files": files}
+                stack.extend(os.path.join(dirpath, name) for name in subdirs)
+        return snapshot, changed
+
+    def reconcile(self):
+        old = self._load()
+        snapshot, changed = self.scan(old or {})
+        self._save(snapshot)
+        # the first snapshot only establishes a baseline, startup already ran a full pass
+        if old is None:
+            print(f"[Reconciler] Baseline snapshot of {len(snapshot)} directories saved")
+            return
+        print(f"[Reconciler] {len(changed)} missed file change(s) found")
+        for path in changed:
+            if not is_ignored(path):
+                self.queue.submit(path)
+
+    def run(self):
+        while True:
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"[Reconciler] Error during reconciliation: {e}")
+                print(traceback.format_exc())
+            if self._stop_event.wait(timeout=self.interval):
+                break
 
 
 class Watcher:
     def __init__(self):
-        self.observer = Observer()
-        self.poller = BackgroundPoller()
+        self.observers = {"inotify": NativeObserver(), "polling": PollingObserver()}
+        self.runs = WorkerRuns()
+        self.queue = WorkQueue(self.runs)
+        self.poller = BackgroundPoller(self.queue, self.runs, on_tick=self.refresh_directories)
+        self.event_handler = Handler(self.queue)
+        self.watches = {}  # directory -> (observer, ObservedWatch)
+        previous = stash_worker.load_watch_directories()
+        # the hash of Stash's library config tells refresh_directories about changes
+        directories, self._stashes_hash = stash_worker.fetch_watch_directories()
+        self.directories_to_watch = directories
+        # library roots added to Stash while the watcher was down
+        self._unscanned = [d for d in directories if previous is not None and d not in previous]
+        self.reconciler = Reconciler(self.queue, self.directories_to_watch)
+        self.ensure_directories(self.directories_to_watch)
+
+    @staticmethod
+    def ensure_directories(directories):
         # make sure each of the directories exists
         # create them if they don't
-        self.directories_to_watch = stash_worker.get_watch_directories()
-
-        for directory in self.directories_to_watch:
+        for directory in directories:
             if not os.path.exists(directory):
                 try:
                     os.makedirs(directory)
@@ -143,13 +717,54 @@ class Watcher:
                     print(f"Error creating directory {directory}: {e}")
                     print(traceback.format_exc())
 
+    def schedule(self, directory):
+        # the observers are already running, so schedule() also starts the emitter
+        # and inotify errors are raised here rather than from observer.start()
+        kind = observer_kind(directory)
+        try:
+            watch = self.observers[kind].schedule(self.event_handler, directory, recursive=True)
+        except OSError as e:
+            # e.g. fs.inotify.max_user_watches exhausted
+            print(f"inotify unavailable for {directory} ({e}), falling back to polling")
+            kind = "polling"
+            watch = self.observers[kind].schedule(self.event_handler, directory, recursive=True)
+        self.watches[directory] = (self.observers[kind], watch)
+        print(f"Watching {directory} with {kind} observer")
+
+    def unschedule(self, directory):
+        observer, watch = self.watches.pop(directory)
+        observer.unschedule(watch)
+        print(f"Stopped watching {directory}")
+
+    def refresh_directories(self):
+        """Follow library paths added to or removed from Stash without a restart."""
+        directories, digest = stash_worker.fetch_watch_directories()
+        if digest is None or digest == self._stashes_hash:
+            return
+        self._stashes_hash = digest
+        added = [d for d in directories if d not in self.watches]
+        removed = [d for d in self.watches if d not in directories]
+        self.ensure_directories(added)
+        for directory in removed:
+            self.unschedule(directory)
+        for directory in added:
+            self.schedule(directory)
+            # a new library root has never been scanned
+            self.queue.submit(directory, closed=True)
+        self.directories_to_watch = directories
+        self.reconciler.directories = list(directories)
+
     def run(self):
-        event_handler = Handler()
+        self.queue.start()
+        for observer in self.observers.values():
+            observer.start()
         for directory in self.directories_to_watch:
             assert os.path.exists(directory), f"Directory {directory} does not exist"
-            self.observer.schedule(event_handler, directory, recursive=True)
-        self.observer.start()
+            self.schedule(directory)
+        for directory in self._unscanned:
+            self.queue.submit(directory, closed=True)
         self.poller.start()
+        self.reconciler.start()
         try:
             print("Watching directories for new files...", self.directories_to_watch)
             print(f"Background polling enabled every {POLL_INTERVAL} seconds ({POLL_INTERVAL // 60} minutes)")
@@ -157,8 +772,12 @@ class Watcher:
                 time.sleep(5)
         except KeyboardInterrupt:
             self.poller.stop()
-            self.observer.stop()
-        self.observer.join()
+            self.reconciler.stop()
+            for observer in self.observers.values():
+                observer.stop()
+            self.queue.stop()
+        for observer in self.observers.values():
+            observer.join()
 
 
 def fix_single_path(path):
@@ -180,23 +799,38 @@ def fix_single_path(path):
 
 
 class Handler(FileSystemEventHandler):
-    def on_created(self, event: FileSystemEvent):
+    def __init__(self, queue: WorkQueue):
+        super().__init__()
+        self.queue = queue
+
+    @staticmethod
+    def _skip(event, path):
+        """True for directories and ignored paths, the latter count as dropped events."""
         if event.is_directory:
+            return True
+        if is_ignored(path):
+            stash_metrics.EVENTS.labels(outcome="dropped").inc()
+            return True
+        return False
+
+    def on_created(self, event: FileSystemEvent):
+        if self._skip(event, event.src_path):
             return None
         else:
             print(f"New file created: {event.src_path}")
             fix_single_path(event.src_path)
             fix_single_path(os.path.dirname(event.src_path))
-            stash_worker.main([event.src_path])
+            self.queue.submit(event.src_path)
 
     def on_moved(self, event: FileSystemEvent):
-        if event.is_directory:
+        # the destination is where the file now lives, e.g. out of .downloading/
+        if self._skip(event, event.dest_path):
             return None
         else:
-            print(f"File moved: {event.src_path}")
-            fix_single_path(event.src_path)
-            fix_single_path(os.path.dirname(event.src_path))
-            stash_worker.main([event.src_path])
+            print(f"File moved: {event.src_path} -> {event.dest_path}")
+            fix_single_path(event.dest_path)
+            fix_single_path(os.path.dirname(event.dest_path))
+            self.queue.submit(event.dest_path, closed=True)
 
     def on_any_event(self, event: FileSystemEvent) -> None:
         """Catch-all event handler.
@@ -223,11 +857,10 @@ class Handler(FileSystemEventHandler):
         :type event:
             :class:`DirModifiedEvent` or :class:`FileModifiedEvent`
         """
-        if event.is_directory:
+        if self._skip(event, event.src_path):
             return None
         else:
-            print(f"File moved: {event.src_path}")
-            stash_worker.main([event.src_path])
+            self.queue.submit(event.src_path)
 
     def on_closed(self, event: FileSystemEvent) -> None:
         """Called when a file opened for writing is closed.
@@ -237,6 +870,9 @@ class Handler(FileSystemEventHandler):
         :type event:
             :class:`FileClosedEvent`
         """
+        if self._skip(event, event.src_path):
+            return None
+        self.queue.submit(event.src_path, closed=True)
 
     def on_opened(self, event: FileSystemEvent) -> None:
         """Called when a file is opened.
@@ -249,6 +885,8 @@ class Handler(FileSystemEventHandler):
 
 
 if __name__ == "__main__":
+    if stash_metrics.start_server():
+        print(f"Serving metrics on :{stash_metrics.METRICS_PORT}/metrics")
     print("Fixing permissions on startup...")
     fix_permissions()
     print("running initial worker")
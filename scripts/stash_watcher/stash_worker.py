@@ -3,14 +3,24 @@
 from pathlib import Path
 
 import time
+import hashlib
 import json
 import traceback
 import requests
 import stashapi.log as log
 from stashapi.stashapp import StashInterface
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse
+from stash_client import GraphQLClient, GraphQLError, register_operation
+from stash_jobs import JobWatcher
+from stash_pipeline import Pipeline, Stage
+from stash_state import StateStore
+import stash_metrics
+import fcntl
 import os
+import re
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 STASH_API_KEY = os.environ["STASH_API_KEY"]
 STASH_BASE_URL = os.environ["STASH_BASE_URL"]
@@ -46,394 +56,1006 @@ connection = {
     "logger": log,
     "ApiKey": STASH_API_KEY,
 }
-STASH_HEADERS = {
-    "content-type": "application/json",
-    "ApiKey": STASH_API_KEY,
+# Last known library paths, kept current by the watcher and read by the worker runs
+WATCH_DIRS_CACHE_FILE = os.environ.get("WATCH_DIRS_CACHE_FILE", "watch_directories.json")
+# Number of scenes requested per findScenes page
+SCENE_PAGE_SIZE = int(os.environ.get("SCENE_PAGE_SIZE", 500))
+# Maximum number of scene IDs sent in a single bulk update
+UPDATE_CHUNK_SIZE = int(os.environ.get("UPDATE_CHUNK_SIZE", 500))
+# phash distance under which scenes count as duplicates
+DEDUPE_DISTANCE = int(os.environ.get("DEDUPE_DISTANCE", 10))
+# Only report which duplicates would be deleted
+DEDUPE_DRY_RUN = os.environ.get("DEDUPE_DRY_RUN", "").lower() in ("1", "true", "yes")
+# Weights of the duplicate scoring criteria as "name=weight,...", the best scored scene of a group is kept
+DEDUPE_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (
+        item.split("=", 1)
+        for item in os.environ.get(
+            "DEDUPE_WEIGHTS",
+            "resolution=4,bitrate=2,codec=1,duration=2,organized=3,size=1",
+        ).split(",")
+        if "=" in item
+    )
 }
+# Scene deletion: scenes per scenesDestroy call, throughput cap (0: none) and scenes per run
+DELETE_CHUNK_SIZE = int(os.environ.get("DELETE_CHUNK_SIZE", 20))
+DELETE_MAX_BYTES_PER_SEC = float(os.environ.get("DELETE_MAX_BYTES_PER_SEC", 200 * 1024**2))
+DELETE_MAX_PER_RUN = int(os.environ.get("DELETE_MAX_PER_RUN", 500))
+# Runs a failing deletion chunk is attempted in before it is marked failed
+DELETE_MAX_ATTEMPTS = int(os.environ.get("DELETE_MAX_ATTEMPTS", 3))
+CODEC_RANK = {"av1": 3, "hevc": 3, "h265": 3, "vp9": 2, "h264": 2, "avc1": 2}
+# Scenes per stash-box identify job, and identify jobs in flight (0: Stash's parallelTasks)
+IDENTIFY_BATCH_SIZE = int(os.environ.get("IDENTIFY_BATCH_SIZE", 50))
+IDENTIFY_CONCURRENCY = int(os.environ.get("IDENTIFY_CONCURRENCY", 0))
+# Number of batches that can be in different pipeline stages at the same time.
+# Only applies to callers submitting several batches to one process through
+# submit(); the watcher runs one batch at a time (WorkerRuns in stash_watcher).
+PIPELINE_MAX_BATCHES = int(os.environ.get("PIPELINE_MAX_BATCHES", 2))
+# Held while a batch runs so a manual run cannot overlap the container's
+WORKER_LOCK_FILE = os.environ.get("WORKER_LOCK_FILE", "stash_worker.lock")
+# Per-artifact generate toggles as "name=true|false,...", e.g. "sprites=false,phashes=true";
+# artifacts not listed keep Stash's generate defaults
+GENERATE_OVERRIDES = {
+    name.strip(): value.strip().lower() in ("1", "true", "yes")
+    for name, value in (
+        item.split("=", 1)
+        for item in os.environ.get("GENERATE_OVERRIDES", "").split(",")
+        if "=" in item
+    )
+}
+# AI tagging: scenes per plugin run are sized so a run takes about AI_BATCH_SECONDS,
+# between AI_BATCH_MIN and AI_BATCH_MAX scenes
+AI_BATCH_SECONDS = float(os.environ.get("AI_BATCH_SECONDS", 15 * 60))
+AI_BATCH_MIN = int(os.environ.get("AI_BATCH_MIN", 5))
+AI_BATCH_MAX = int(os.environ.get("AI_BATCH_MAX", 100))
+# Plugin runs a scene may stay tagged AI_TagMe through before it is given up for good
+AI_MAX_ATTEMPTS = int(os.environ.get("AI_MAX_ATTEMPTS", 3))
+# Health probe of the AI server and the circuit breaker in front of it
+AI_HEALTH_PATH = os.environ.get("AI_HEALTH_PATH", "/docs")
+AI_HEALTH_TIMEOUT = float(os.environ.get("AI_HEALTH_TIMEOUT", 5))
+AI_BREAKER_THRESHOLD = int(os.environ.get("AI_BREAKER_THRESHOLD", 3))
+AI_BREAKER_COOLDOWN = float(os.environ.get("AI_BREAKER_COOLDOWN", 10 * 60))
+# Seconds between checks of the AI queue when nothing woke the tagger
+AI_IDLE_INTERVAL = float(os.environ.get("AI_IDLE_INTERVAL", 5 * 60))
+# Seconds between library-wide generates (0: never), runs in between only
+# generate for the scenes they touched
+FULL_GENERATE_INTERVAL = int(os.environ.get("FULL_GENERATE_INTERVAL", 7 * 24 * 3600))
 
 
-FIND_SCENES_FRAGMENT = """
-fragment SlimSceneData on Scene {
-  id
-  title
-  code
-  details
-  director
-  urls
-  date
-  rating100
-  o_counter
-  organized
-  interactive
-  interactive_speed
-  resume_time
-  play_duration
-  play_count
-  files {
-    ...VideoFileData
-    __typename
-  }
-  paths {
-    screenshot
-    preview
-    stream
-    webp
-    vtt
-    sprite
-    funscript
-    interactive_heatmap
-    caption
-    __typename
-  }
-  scene_markers {
-    id
-    title
-    seconds
-    primary_tag {
-      id
-      name
-      __typename
-    }
-    __typename
-  }
-  galleries {
-    id
-    files {
-      path
-      __typename
-    }
-    folder {
-      path
-      __typename
-    }
-    title
-    __typename
-  }
-  studio {
-    id
-    name
-    image_path
-    __typename
-  }
-  groups {
-    group {
-      id
-      name
-      front_image_path
-      __typename
+WATCH_DIRECTORIES_OPERATION = register_operation(
+    "WatchDirectories",
+    """
+    query WatchDirectories {
+        configuration {
+            general {
+                stashes {
+                    path
+                    excludeVideo
+                    excludeImage
+                }
+            }
+        }
     }
-    scene_index
-    __typename
-  }
-  tags {
-    id
-    name
-    __typename
-  }
-  performers {
-    id
-    name
-    disambiguation
-    gender
-    favorite
-    image_path
-    __typename
-  }
-  stash_ids {
-    endpoint
-    stash_id
-    __typename
-  }
-  __typename
-}
+    """,
+)
 
-fragment VideoFileData on VideoFile {
-  id
-  path
-  size
-  mod_time
-  duration
-  video_codec
-  audio_codec
-  width
-  height
-  frame_rate
-  bit_rate
-  fingerprints {
-    type
-    value
-    __typename
-  }
-  __typename
-}"""
-FIND_SCENES_FRAGMENT = None
 
+def _load_watch_directories_cache():
+    try:
+        with open(WATCH_DIRS_CACHE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
-def get_watch_directories():
-    json_data = {
-        "operationName": "Configuration",
-        "variables": {},
-        "query": "query Configuration {\n  configuration {\n    ...ConfigData\n    __typename\n  }\n}\n\nfragment ConfigData on ConfigResult {\n  general {\n    ...ConfigGeneralData\n    __typename\n  }\n  interface {\n    ...ConfigInterfaceData\n    __typename\n  }\n  dlna {\n    ...ConfigDLNAData\n    __typename\n  }\n  scraping {\n    ...ConfigScrapingData\n    __typename\n  }\n  defaults {\n    ...ConfigDefaultSettingsData\n    __typename\n  }\n  ui\n  plugins\n  __typename\n}\n\nfragment ConfigGeneralData on ConfigGeneralResult {\n  stashes {\n    path\n    excludeVideo\n    excludeImage\n    __typename\n  }\n  databasePath\n  backupDirectoryPath\n  generatedPath\n  metadataPath\n  scrapersPath\n  pluginsPath\n  cachePath\n  blobsPath\n  blobsStorage\n  ffmpegPath\n  ffprobePath\n  calculateMD5\n  videoFileNamingAlgorithm\n  parallelTasks\n  previewAudio\n  previewSegments\n  previewSegmentDuration\n  previewExcludeStart\n  previewExcludeEnd\n  previewPreset\n  transcodeHardwareAcceleration\n  maxTranscodeSize\n  maxStreamingTranscodeSize\n  writeImageThumbnails\n  createImageClipsFromVideos\n  apiKey\n  username\n  password\n  maxSessionAge\n  logFile\n  logOut\n  logLevel\n  logAccess\n  createGalleriesFromFolders\n  galleryCoverRegex\n  videoExtensions\n  imageExtensions\n  galleryExtensions\n  excludes\n  imageExcludes\n  customPerformerImageLocation\n  stashBoxes {\n    name\n    endpoint\n    api_key\n    __typename\n  }\n  pythonPath\n  transcodeInputArgs\n  transcodeOutputArgs\n  liveTranscodeInputArgs\n  liveTranscodeOutputArgs\n  drawFunscriptHeatmapRange\n  scraperPackageSources {\n    name\n    url\n    local_path\n    __typename\n  }\n  pluginPackageSources {\n    name\n    url\n    local_path\n    __typename\n  }\n  __typename\n}\n\nfragment ConfigInterfaceData on ConfigInterfaceResult {\n  menuItems\n  soundOnPreview\n  wallShowTitle\n  wallPlayback\n  showScrubber\n  maximumLoopDuration\n  noBrowser\n  notificationsEnabled\n  autostartVideo\n  autostartVideoOnPlaySelected\n  continuePlaylistDefault\n  showStudioAsText\n  css\n  cssEnabled\n  javascript\n  javascriptEnabled\n  customLocales\n  customLocalesEnabled\n  language\n  imageLightbox {\n    slideshowDelay\n    displayMode\n    scaleUp\n    resetZoomOnNav\n    scrollMode\n    scrollAttemptsBeforeChange\n    __typename\n  }\n  disableDropdownCreate {\n    performer\n    tag\n    studio\n    movie\n    __typename\n  }\n  handyKey\n  funscriptOffset\n  useStashHostedFunscript\n  __typename\n}\n\nfragment ConfigDLNAData on ConfigDLNAResult {\n  serverName\n  enabled\n  port\n  whitelistedIPs\n  interfaces\n  videoSortOrder\n  __typename\n}\n\nfragment ConfigScrapingData on ConfigScrapingResult {\n  scraperUserAgent\n  scraperCertCheck\n  scraperCDPPath\n  excludeTagPatterns\n  __typename\n}\n\nfragment ConfigDefaultSettingsData on ConfigDefaultSettingsResult {\n  scan {\n    scanGenerateCovers\n    scanGeneratePreviews\n    scanGenerateImagePreviews\n    scanGenerateSprites\n    scanGeneratePhashes\n    scanGenerateThumbnails\n    scanGenerateClipPreviews\n    __typename\n  }\n  identify {\n    sources {\n      source {\n        ...ScraperSourceData\n        __typename\n      }\n      options {\n        ...IdentifyMetadataOptionsData\n        __typename\n      }\n      __typename\n    }\n    options {\n      ...IdentifyMetadataOptionsData\n      __typename\n    }\n    __typename\n  }\n  autoTag {\n    performers\n    studios\n    tags\n    __typename\n  }\n  generate {\n    covers\n    sprites\n    previews\n    imagePreviews\n    previewOptions {\n      previewSegments\n      previewSegmentDuration\n      previewExcludeStart\n      previewExcludeEnd\n      previewPreset\n      __typename\n    }\n    markers\n    markerImagePreviews\n    markerScreenshots\n    transcodes\n    phashes\n    interactiveHeatmapsSpeeds\n    clipPreviews\n    imageThumbnails\n    __typename\n  }\n  deleteFile\n  deleteGenerated\n  __typename\n}\n\nfragment ScraperSourceData on ScraperSource {\n  stash_box_index\n  stash_box_endpoint\n  scraper_id\n  __typename\n}\n\nfragment IdentifyMetadataOptionsData on IdentifyMetadataOptions {\n  fieldOptions {\n    ...IdentifyFieldOptionsData\n    __typename\n  }\n  setCoverImage\n  setOrganized\n  includeMalePerformers\n  skipMultipleMatches\n  skipMultipleMatchTag\n  skipSingleNamePerformers\n  skipSingleNamePerformerTag\n  __typename\n}\n\nfragment IdentifyFieldOptionsData on IdentifyFieldOptions {\n  field\n  strategy\n  createMissing\n  __typename\n}",
-    }
 
-    response = requests.post(
-        STASH_BASE_URL + "/graphql", headers=STASH_HEADERS, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    stashes = response.json()["data"]["configuration"]["general"]["stashes"]
+def load_watch_directories():
+    """Library paths as last fetched from Stash, None if they never were."""
+    cached = _load_watch_directories_cache()
+    return cached["paths"] if cached else None
+
+
+def fetch_watch_directories():
+    """Fetch the library paths from Stash and cache them in WATCH_DIRS_CACHE_FILE.
+
+    If Stash cannot be reached the cached paths are returned instead.
+
+    Returns:
+        tuple: (paths, hash of the ``stashes`` config or None if not fetched)
+    """
+    cached = load_watch_directories()
+    try:
+        data = get_client().execute(WATCH_DIRECTORIES_OPERATION)
+    except Exception as e:
+        if cached is None:
+            raise
+        log.error(f"Failed to fetch library paths, using cached ones: {e}")
+        return cached, None
+    stashes = data["configuration"]["general"]["stashes"]
+    digest = hashlib.sha256(json.dumps(stashes, sort_keys=True).encode()).hexdigest()
     paths = [
         x["path"] for x in stashes if not x["excludeVideo"] or not x["excludeImage"]
     ]
-    return paths
-
-
-# this is what works rn
-def find_scenes(
-    self,
-    f: dict = {},
-    filter: dict = {"per_page": -1},
-    q: str = "",
-    fragment=None,
-    get_count=False,
-    callback=None,
-):
-    import re
+    if paths != cached:
+        try:
+            with open(WATCH_DIRS_CACHE_FILE, "w") as f:
+                json.dump({"paths": paths}, f)
+        except OSError as e:
+            log.error(f"Failed to write {WATCH_DIRS_CACHE_FILE}: {e}")
+    return paths, digest
+
+
+def get_watch_directories():
+    """Library paths, from the cache the watcher keeps current if there is one."""
+    paths = load_watch_directories()
+    return fetch_watch_directories()[0] if paths is None else paths
+
 
-    query = """
-    query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType, $scene_ids: [Int!]) {
-        findScenes(filter: $filter, scene_filter: $scene_filter, scene_ids: $scene_ids) {
+LIBRARY_FINGERPRINT_OPERATION = register_operation(
+    "LibraryFingerprint",
+    """
+    query LibraryFingerprint {
+        created: findScenes(filter: {per_page: 1, sort: "created_at", direction: DESC}) {
             count
             scenes {
                 id
-                title
-                code
-                details
-                director
-                urls
-                date
-                rating100
-                o_counter
-                organized
-                interactive
-                interactive_speed
-                resume_time
-                play_duration
-                play_count
+                created_at
+            }
+        }
+        modified: findScenes(filter: {per_page: 1, sort: "file_mod_time", direction: DESC}) {
+            scenes {
                 files {
-                    id
-                    path
-                    size
                     mod_time
-                    duration
-                    video_codec
-                    audio_codec
-                    width
-                    height
-                    frame_rate
-                    bit_rate
-                    fingerprints {
-                        type
-                        value
-                    }
-                }
-                paths {
-                    screenshot
-                    preview
-                    stream
-                    webp
-                    vtt
-                    sprite
-                    funscript
-                    interactive_heatmap
-                    caption
-                }
-                scene_markers {
-                    id
-                    title
-                    seconds
-                    primary_tag {
-                        id
-                        name
-                    }
-                }
-                galleries {
-                    id
-                    files {
-                        path
-                    }
-                    folder {
-                        path
-                    }
-                    title
-                }
-                studio {
-                    id
-                    name
-                    image_path
-                }
-                movies {
-                    movie {
-                        id
-                        name
-                        front_image_path
-                    }
-                    scene_index
-                }
-                tags {
-                    id
-                    name
-                }
-                performers {
-                    id
-                    name
-                    disambiguation
-                    gender
-                    favorite
-                    image_path
-                }
-                stash_ids {
-                    endpoint
-                    stash_id
                 }
             }
         }
     }
+    """,
+)
+
+
+def library_fingerprint():
+    """Cheap summary of the scene library that changes whenever a scene is
+    added or removed or a file is replaced: (count, id and created_at of the
+    newest scene, latest file mod_time).
+
+    Scene ``updated_at`` is left out on purpose, the worker's own tag and
+    metadata writes bump it and would make every pass look like a change.
+    """
+    data = get_client().execute(LIBRARY_FINGERPRINT_OPERATION)
+    newest = data["created"]["scenes"][0] if data["created"]["scenes"] else {}
+    modified = data["modified"]["scenes"][0]["files"] if data["modified"]["scenes"] else []
+    return (
+        data["created"]["count"],
+        newest.get("id"),
+        newest.get("created_at"),
+        max((f["mod_time"] for f in modified), default=None),
+    )
+
+
+# Field projections for iter_scenes, keep them as small as the call site allows
+SCENE_FIELDS_ID = "id"
+
+FIND_SCENES_QUERY = """
+query FindScenes($filter: FindFilterType, $scene_filter: SceneFilterType, $scene_ids: [Int!]) {
+    findScenes(filter: $filter, scene_filter: $scene_filter, scene_ids: $scene_ids) {
+        scenes {
+            %s
+        }
+    }
+}
+"""
+
+
+def iter_scenes(
+    stash,
+    f: dict = None,
+    fields: str = SCENE_FIELDS_ID,
+    scene_ids=None,
+    per_page: int = SCENE_PAGE_SIZE,
+):
+    """Yield scenes matching the scene filter ``f`` one page at a time.
+
+    Args:
+        f (dict, optional): SceneFilterType passed to findScenes.
+        fields (str, optional): selection set for each scene. Defaults to ids only.
+        scene_ids (list, optional): restrict the query to these scene IDs.
+        per_page (int, optional): page size. Defaults to SCENE_PAGE_SIZE.
     """
-    if fragment:
-        query = re.sub(r"\.\.\.Scene", fragment, query)
+    if scene_ids is not None:
+        # findScenes treats an empty scene_ids list as "no restriction"
+        if not scene_ids:
+            return
+        scene_ids = [int(scene_id) for scene_id in scene_ids]
+    query = FIND_SCENES_QUERY % fields
+    page = 1
+    while True:
+        variables = {
+            # created_at keeps pages stable while new scenes are being added
+            "filter": {
+                "page": page,
+                "per_page": per_page,
+                "sort": "created_at",
+                "direction": "ASC",
+            },
+            "scene_filter": f or {},
+            "scene_ids": scene_ids,
+        }
+        scenes = stash.call_GQL(query, variables)["findScenes"]["scenes"]
+        yield from scenes
+        if len(scenes) < per_page:
+            return
+        page += 1
 
-    filter["q"] = q
-    variables = {"filter": filter, "scene_filter": f}
 
-    result = self.call_GQL(query, variables, callback=callback)
-    if get_count:
-        return result["findScenes"]["count"], result["findScenes"]["scenes"]
-    else:
-        return result["findScenes"]["scenes"]
+def chunked(items, size):
+    """Split a list into consecutive chunks of at most ``size`` items."""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
 
 
-def delete_scene_ids(ids_to_delete):
-    json_data = {
-        "operationName": "ScenesDestroy",
-        "variables": {
+_tag_ids = {}
+
+
+def get_tag_id(stash, name):
+    """Resolve a tag name to its ID, cached for the lifetime of the process."""
+    if name not in _tag_ids:
+        tag = stash.find_tag(name)
+        if not tag:
+            return None
+        _tag_ids[name] = tag["id"]
+    return _tag_ids[name]
+
+
+def find_untagged_scenes(stash, scene_ids=None):
+    """IDs of the scenes that have neither AI_Tagged nor AI_TagMe.
+
+    The candidates are selected by Stash with a tag EXCLUDES filter, so the cost
+    scales with the number of untagged scenes rather than the library size.
+    """
+    tag_me_id = get_tag_id(stash, "AI_TagMe")
+    if tag_me_id is None:
+        log.error("AI_TagMe tag not found, skipping AI tagging")
+        return []
+    excluded_tag_ids = [tag_me_id]
+    tagged_id = get_tag_id(stash, "AI_Tagged")
+    if tagged_id is not None:
+        excluded_tag_ids.append(tagged_id)
+    return [
+        scene["id"]
+        for scene in iter_scenes(
+            stash,
+            f={"tags": {"value": excluded_tag_ids, "modifier": "EXCLUDES", "depth": 0}},
+            scene_ids=scene_ids,
+        )
+    ]
+
+
+def update_scene_tag(stash, scene_ids, tag_id, mode="ADD"):
+    """Add (or with ``mode="REMOVE"`` remove) a tag on scenes in bulk."""
+    for chunk in chunked(list(scene_ids), UPDATE_CHUNK_SIZE):
+        stash.update_scenes(
+            {
+                "ids": chunk,
+                "tag_ids": {"mode": mode, "ids": [tag_id]},
+            }
+        )
+
+
+SCENES_DESTROY_OPERATION = register_operation(
+    "ScenesDestroy",
+    "mutation ScenesDestroy($ids: [ID!]!, $delete_file: Boolean, $delete_generated: Boolean) {\n  scenesDestroy(\n    input: {ids: $ids, delete_file: $delete_file, delete_generated: $delete_generated}\n  )\n}",
+)
+
+
+def destroy_scenes(ids_to_delete):
+    """Destroy scenes together with their files and generated content."""
+    return get_client().execute(
+        SCENES_DESTROY_OPERATION,
+        {
             "ids": ids_to_delete,
             "delete_file": True,
             "delete_generated": True,
         },
-        "query": "mutation ScenesDestroy($ids: [ID!]!, $delete_file: Boolean, $delete_generated: Boolean) {\n  scenesDestroy(\n    input: {ids: $ids, delete_file: $delete_file, delete_generated: $delete_generated}\n  )\n}",
-    }
+    )
+
+
+def delete_scene_ids(ids_to_delete, sizes=None):
+    """Delete scenes in journaled, throttled chunks.
+
+    The chunks of DELETE_CHUNK_SIZE scenes are journaled in the state store
+    before the first one is executed, then run_pending_deletions works through
+    the journal. Scenes already journaled by an earlier run are not added
+    again, and what exceeds DELETE_MAX_PER_RUN stays journaled for a later run.
 
-    response = requests.post(
-        STASH_BASE_URL + "/graphql", headers=STASH_HEADERS, json=json_data, verify=False
+    Args:
+        ids_to_delete (list): scene IDs
+        sizes (dict, optional): scene ID -> bytes on disk, used for throttling
+    """
+    sizes = sizes or {}
+    state = get_state()
+    journaled = state.pending_deletion_ids()
+    ids_to_delete = [i for i in ids_to_delete if str(i) not in journaled]
+    state.journal_deletions(
+        (chunk, sum(sizes.get(scene_id, 0) for scene_id in chunk))
+        for chunk in chunked(list(ids_to_delete), DELETE_CHUNK_SIZE)
     )
-    response.raise_for_status()
-    return response.json()
+    return run_pending_deletions()
 
 
-def get_duplicate_scenes():
-    json_data = {
-        "operationName": "FindDuplicateScenes",
-        "variables": {
-            "distance": 10,
-            "duration_diff": -1,
-        },
-        "query": "query FindDuplicateScenes($distance: Int, $duration_diff: Float) {\n  findDuplicateScenes(distance: $distance, duration_diff: $duration_diff) {\n    ...SlimSceneData\n    __typename\n  }\n}\n\nfragment SlimSceneData on Scene {\n  id\n  title\n  code\n  details\n  director\n  urls\n  date\n  rating100\n  o_counter\n  organized\n  interactive\n  interactive_speed\n  resume_time\n  play_duration\n  play_count\n  files {\n    ...VideoFileData\n    __typename\n  }\n  paths {\n    screenshot\n    preview\n    stream\n    webp\n    vtt\n    sprite\n    funscript\n    interactive_heatmap\n    caption\n    __typename\n  }\n  scene_markers {\n    id\n    title\n    seconds\n    primary_tag {\n      id\n      name\n      __typename\n    }\n    __typename\n  }\n  galleries {\n    id\n    files {\n      path\n      __typename\n    }\n    folder {\n      path\n      __typename\n    }\n    title\n    __typename\n  }\n  studio {\n    id\n    name\n    image_path\n    __typename\n  }\n  movies {\n    movie {\n      id\n      name\n      front_image_path\n      __typename\n    }\n    scene_index\n    __typename\n  }\n  tags {\n    id\n    name\n    __typename\n  }\n  performers {\n    id\n    name\n    disambiguation\n    gender\n    favorite\n    image_path\n    __typename\n  }\n  stash_ids {\n    endpoint\n    stash_id\n    __typename\n  }\n  __typename\n}\n\nfragment VideoFileData on VideoFile {\n  id\n  path\n  size\n  mod_time\n  duration\n  video_codec\n  audio_codec\n  width\n  height\n  frame_rate\n  bit_rate\n  fingerprints {\n    type\n    value\n    __typename\n  }\n  __typename\n}",
+def run_pending_deletions(max_scenes=None):
+    """Execute journaled deletion chunks, resuming any left by an interrupted run.
+
+    Stops once ``max_scenes`` (default DELETE_MAX_PER_RUN) scenes were attempted. After each chunk, sleeps
+    long enough to stay under DELETE_MAX_BYTES_PER_SEC. A chunk that fails is
+    retried by the next runs, up to DELETE_MAX_ATTEMPTS attempts.
+
+    Returns:
+        list: IDs of the scenes that were deleted
+    """
+    max_scenes = DELETE_MAX_PER_RUN if max_scenes is None else max_scenes
+    state = get_state()
+    deleted = []
+    attempted = 0
+    pending = state.pending_deletions()
+    for n, (chunk_id, scene_ids, nbytes) in enumerate(pending):
+        if attempted and attempted + len(scene_ids) > max_scenes:
+            log.info(f"{len(pending) - n} deletion chunks left for the next run")
+            break
+        attempted += len(scene_ids)
+        started = time.monotonic()
+        try:
+            destroy_scenes(scene_ids)
+        except (GraphQLError, requests.RequestException) as e:
+            # transient errors, or scenes already gone after a crash between destroy and journal update
+            gave_up = state.retry_deletion(chunk_id, DELETE_MAX_ATTEMPTS)
+            log.error(
+                f"Failed to delete scenes {scene_ids}"
+                + (", giving up" if gave_up else ", retrying next run")
+                + f": {e}"
+            )
+            continue
+        state.finish_deletion(chunk_id)
+        deleted += scene_ids
+        log.info(f"Deleted {len(scene_ids)} scenes ({nbytes / 1e9:.1f} GB)")
+        if DELETE_MAX_BYTES_PER_SEC > 0:
+            time.sleep(max(nbytes / DELETE_MAX_BYTES_PER_SEC - (time.monotonic() - started), 0))
+    return deleted
+
+
+# Only what duplicate scoring reads
+DUPLICATE_SCENE_FIELDS = """
+id
+organized
+files {
+    size
+    duration
+    video_codec
+    width
+    height
+    bit_rate
+    fingerprints {
+        type
+        value
     }
+}
+"""
+
+
+FIND_DUPLICATE_SCENES_OPERATION = register_operation(
+    "FindDuplicateScenes",
+    "query FindDuplicateScenes($distance: Int, $duration_diff: Float) {\n  findDuplicateScenes(distance: $distance, duration_diff: $duration_diff) {"
+    + DUPLICATE_SCENE_FIELDS
+    + "}\n}",
+)
 
-    response = requests.post(
-        STASH_BASE_URL + "/graphql", headers=STASH_HEADERS, json=json_data, verify=False
+
+def get_duplicate_scenes(distance=DEDUPE_DISTANCE):
+    """Library-wide duplicate groups, used when no scene IDs are known."""
+    data = get_client().execute(
+        FIND_DUPLICATE_SCENES_OPERATION, {"distance": distance, "duration_diff": -1}
     )
-    response.raise_for_status()
-    return response.json()
+    return data["findDuplicateScenes"]
+
+
+def get_phashes(scene):
+    return {
+        fingerprint["value"]
+        for file in scene["files"]
+        for fingerprint in file["fingerprints"]
+        if fingerprint["type"] == "phash"
+    }
 
 
-def del_duplicates_main():
-    data = get_duplicate_scenes()
-    # for each group we want to select all files except the largest one
+def find_duplicate_groups(stash, scene_ids, distance=DEDUPE_DISTANCE):
+    """Duplicate groups that contain at least one of ``scene_ids``.
+
+    Each scene's phashes are matched with a phash_distance filter instead of a
+    library-wide findDuplicateScenes. Matches are cached per phash, so scenes
+    sharing a phash (and scenes already grouped) cost no extra query.
+
+    A scene is never put in two groups: with A~C and B~C, A and B are not
+    duplicates of each other, and scoring both groups could delete every copy.
+    """
+    matches_by_phash = {}
+    grouped = set()
+    groups = []
+    for scene in iter_scenes(stash, fields=DUPLICATE_SCENE_FIELDS, scene_ids=scene_ids):
+        if scene["id"] in grouped:
+            continue
+        group = {scene["id"]: scene}
+        for phash in get_phashes(scene):
+            if phash not in matches_by_phash:
+                matches_by_phash[phash] = list(
+                    iter_scenes(
+                        stash,
+                        f={
+                            "phash_distance": {
+                                "value": phash,
+                                "distance": distance,
+                                "modifier": "EQUALS",
+                            }
+                        },
+                        fields=DUPLICATE_SCENE_FIELDS,
+                    )
+                )
+            group.update(
+                (match["id"], match)
+                for match in matches_by_phash[phash]
+                if match["id"] not in grouped
+            )
+        if len(group) > 1:
+            grouped.update(group)
+            groups.append(list(group.values()))
+    return groups
+
+
+def disjoint_groups(groups):
+    """Drop scenes already in an earlier group, and groups left with a single scene."""
+    grouped = set()
+    result = []
+    for scenes in groups:
+        scenes = [scene for scene in scenes if scene["id"] not in grouped]
+        if len(scenes) > 1:
+            grouped.update(scene["id"] for scene in scenes)
+            result.append(scenes)
+    return result
+
+
+def score_duplicates(scenes, weights=None):
+    """Score each scene of a duplicate group, higher is better.
+
+    Every criterion is normalised to 0..1 within the group before weighting:
+    resolution, bitrate and size relative to the group maximum, codec by
+    CODEC_RANK, duration by closeness to the group median, organized as 0/1.
+
+    Scenes without files are left out, they cannot be compared.
+
+    Returns:
+        list: (score, scene) pairs, best first
+    """
+    weights = DEDUPE_WEIGHTS if weights is None else weights
+    scenes = [scene for scene in scenes if scene["files"]]
+    if not scenes:
+        return []
+    files = {
+        scene["id"]: max(scene["files"], key=lambda f: f["size"] or 0)
+        for scene in scenes
+    }
+    pixels = {k: (f["width"] or 0) * (f["height"] or 0) for k, f in files.items()}
+    durations = sorted(f["duration"] or 0 for f in files.values())
+    median = durations[len(durations) // 2] or 1
+    max_pixels = max(pixels.values()) or 1
+    max_bitrate = max(f["bit_rate"] or 0 for f in files.values()) or 1
+    max_size = max(f["size"] or 0 for f in files.values()) or 1
+    top_codec = max(CODEC_RANK.values())
+
+    scored = []
+    for scene in scenes:
+        f = files[scene["id"]]
+        criteria = {
+            "resolution": pixels[scene["id"]] / max_pixels,
+            "bitrate": (f["bit_rate"] or 0) / max_bitrate,
+            "size": (f["size"] or 0) / max_size,
+            "codec": CODEC_RANK.get((f["video_codec"] or "").lower(), 0) / top_codec,
+            "duration": 1 - min(abs((f["duration"] or 0) - median) / median, 1),
+            "organized": 1.0 if scene["organized"] else 0.0,
+        }
+        score = sum(weights.get(name, 0) * value for name, value in criteria.items())
+        scored.append((score, scene))
+    # ties fall back to the largest file, which is all that was compared before scoring
+    scored.sort(key=lambda item: (item[0], files[item[1]["id"]]["size"] or 0), reverse=True)
+    return scored
+
+
+def del_duplicates_main(stash, scene_ids=None, dry_run=DEDUPE_DRY_RUN):
+    """Delete all but the best scored scene of each duplicate group.
+
+    With ``scene_ids`` only groups touching those scenes are evaluated.
+
+    Returns:
+        list: IDs of the deleted (or, in a dry run, to be deleted) scenes
+    """
+    if scene_ids is None:
+        groups = disjoint_groups(get_duplicate_scenes())
+    else:
+        groups = find_duplicate_groups(stash, scene_ids)
+
     ids_to_delete = []
-    for scenes in data["data"]["findDuplicateScenes"]:
-        scenes.sort(key=lambda scene: max([f["size"] for f in scene["files"]]))
-        for scene in scenes[:-1]:
+    sizes = {}
+    for scenes in groups:
+        scored = score_duplicates(scenes)
+        if len(scored) < 2:
+            continue
+        keep_score, keep = scored[0]
+        report = f"keep {keep['id']} ({keep_score:.2f})"
+        for score, scene in scored[1:]:
             ids_to_delete.append(scene["id"])
+            sizes[scene["id"]] = sum(f["size"] or 0 for f in scene["files"])
+            report += f", delete {scene['id']} ({score:.2f})"
+        log.info(("[dry-run] " if dry_run else "") + "Duplicates: " + report)
 
-    print("IDs to delete", ids_to_delete)
+    if dry_run:
+        return ids_to_delete
+    # chunks journaled by earlier runs go first
+    return delete_scene_ids(ids_to_delete, sizes)
 
-    if ids_to_delete:
-        delete_scene_ids(ids_to_delete)
 
+def get_scan_paths(paths):
+    """Expand incoming paths into the paths Stash should scan.
 
-def get_closest_parent_directory(path):
-    path = Path(path)
-    if path.is_dir():
-        return str(path)
-    if path.is_file():
-        return str(path.parent)
+    Paths that no longer exist (moved or deleted) are covered by scanning their
+    parent directory; ``path_mutation`` equivalents are appended.
+    """
+    scan_paths = []
+    for path in map(Path, paths):
+        scan_paths.append(str(path if path.exists() else path.parent))
+    scan_paths += [
+        path.replace(old, new)
+        for path in scan_paths
+        for old, new in path_mutation.items()
+        if old in path
+    ]
+    return list(dict.fromkeys(scan_paths))
 
 
-def wait_for_job(stash, job_id, status="FINISHED", period=1.5, timeout=12000):
-    """Waits for stash job to match desired status
+def covers_library(paths):
+    """True when ``paths`` include every library root."""
+    paths = {os.path.normpath(path) for path in paths}
+    return all(os.path.normpath(root) in paths for root in get_watch_directories())
 
-    Args:
-        job_id (ID): the ID of the job to wait for
-        status (str, optional): Desired status to wait for. Defaults to "FINISHED".
-        period (float, optional): Interval between checks for job status. Defaults to 1.5.
-        timeout (int, optional): time in seconds that if exceeded raises Exception. Defaults to 120.
 
-    Raises:
-        Exception: timeout raised if wait task takes longer than timeout
+def path_prefix_regex(path):
+    """Regex matching ``path`` itself or anything below it."""
+    # escaped by hand, Stash uses Go's regexp which rejects escaped spaces
+    escaped = re.sub(r"([\\.^$|?*+()\[\]{}])", r"\\\1", path.rstrip("/"))
+    return f"^{escaped}(/|$)"
+
+
+def find_scene_ids_under(stash, paths):
+    """Return the IDs of scenes with a file under any of ``paths``."""
+    scene_ids = set()
+    for path in paths:
+        scenes = iter_scenes(
+            stash, f={"path": {"value": path_prefix_regex(path), "modifier": "MATCHES_REGEX"}}
+        )
+        scene_ids.update(scene["id"] for scene in scenes)
+    return sorted(scene_ids, key=int)
+
+
+GENERATE_DEFAULTS_OPERATION = register_operation(
+    "ConfigurationGenerateDefaults",
+    """
+    query ConfigurationGenerateDefaults {
+        configuration {
+            defaults {
+                generate {
+                    covers
+                    sprites
+                    previews
+                    imagePreviews
+                    markers
+                    markerImagePreviews
+                    markerScreenshots
+                    transcodes
+                    phashes
+                    interactiveHeatmapsSpeeds
+                    clipPreviews
+                    imageThumbnails
+                }
+            }
+        }
+    }
+    """,
+)
+
+METADATA_GENERATE_OPERATION = register_operation(
+    "MetadataGenerate",
+    "mutation MetadataGenerate($input: GenerateMetadataInput!) { metadataGenerate(input: $input) }",
+)
+
+
+def metadata_generate(scene_ids=None):
+    """Start a generate job using Stash's default generate options and GENERATE_OVERRIDES.
+
+    When ``scene_ids`` is given the job only covers those scenes instead of
+    walking the whole library.
+    """
+    client = get_client()
+    defaults = client.execute(GENERATE_DEFAULTS_OPERATION)["configuration"]["defaults"]
+    generate_input = dict(defaults.get("generate") or {})
+    generate_input.update(GENERATE_OVERRIDES)
+    if scene_ids is not None:
+        generate_input["sceneIDs"] = list(scene_ids)
+    result = client.execute(METADATA_GENERATE_OPERATION, {"input": generate_input})
+    return result["metadataGenerate"]
+
+
+_client = None
+_stash = None
+_clients_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide GraphQLClient."""
+    global _client
+    with _clients_lock:
+        if _client is None:
+            _client = GraphQLClient(STASH_BASE_URL, STASH_API_KEY)
+        return _client
+
+
+GQL_OPERATION_NAME = re.compile(r"\b(?:query|mutation)\s+(\w+)")
+
+
+def _counted_call_GQL(call_GQL):
+    """Count requests made through stashapi by operation name."""
+
+    def counted(query, *args, **kwargs):
+        match = GQL_OPERATION_NAME.search(query)
+        operation = match.group(1) if match else "anonymous"
+        stash_metrics.GRAPHQL_BYTES.labels(operation, "sent").inc(len(query))
+        try:
+            result = call_GQL(query, *args, **kwargs)
+        except Exception:
+            stash_metrics.GRAPHQL_REQUESTS.labels(operation, "error").inc()
+            raise
+        stash_metrics.GRAPHQL_REQUESTS.labels(operation, "ok").inc()
+        return result
+
+    return counted
+
+
+def get_stash():
+    """Return the process-wide StashInterface, built once instead of per run."""
+    global _stash
+    with _clients_lock:
+        if _stash is None:
+            _stash = StashInterface(connection)
+            _stash.wait_for_job = wait_for_job.__get__(_stash, StashInterface)
+            _stash.call_GQL = _counted_call_GQL(_stash.call_GQL)
+        return _stash
+
+
+_job_watcher = None
+
+
+def get_job_watcher(stash):
+    """Return the process-wide JobWatcher, starting its subscription on first use."""
+    global _job_watcher
+    with _clients_lock:
+        if _job_watcher is None:
+            ws_scheme = "wss" if url.scheme == "https" else "ws"
+            ws_url = urlunparse(url._replace(scheme=ws_scheme, path="/graphql"))
+            _job_watcher = JobWatcher(stash, ws_url=ws_url, api_key=STASH_API_KEY)
+            _job_watcher.start()
+        return _job_watcher
+
+
+def wait_for_job(
+    stash, job_id, status="FINISHED", period=1.5, timeout=12000, kind=None
+):
+    """Waits for stash job to match desired status, see JobWatcher.wait
+
+    The outcome is recorded in the job history of the state store.
+    """
+    watcher = get_job_watcher(stash)
+    result = watcher.wait(job_id, status, period, timeout)
+    if result is not None:
+        outcome = status if result else "FAILED"
+        duration = watcher.durations.pop(str(job_id), None)
+        get_state().record_job(job_id, kind, outcome, duration)
+        if duration is not None:
+            stash_metrics.JOB_SECONDS.labels(kind or "other", outcome).observe(duration)
+    return result
+
+
+_state = None
+_state_lock = threading.Lock()
+
+
+def get_state():
+    """Return the process-wide StateStore."""
+    global _state
+    with _state_lock:
+        if _state is None:
+            _state = StateStore()
+        return _state
+
+
+PARALLEL_TASKS_OPERATION = register_operation(
+    "ParallelTasks", "query ParallelTasks { configuration { general { parallelTasks } } }"
+)
+
+
+def get_parallel_tasks():
+    """Stash's configured parallelTasks, 1 when it is left on auto (0)."""
+    try:
+        general = get_client().execute(PARALLEL_TASKS_OPERATION)
+        return max(general["configuration"]["general"]["parallelTasks"], 1)
+    except Exception as e:
+        log.error(f"Failed to read parallelTasks: {e}")
+        return 1
+
+
+def identify_scenes(stash, scene_ids):
+    """Identify scenes against stash-box in bounded batches.
+
+    Batches are submitted as separate identify jobs, at most
+    IDENTIFY_CONCURRENCY (default: Stash's parallelTasks) in flight. The
+    identify task sets organized on success, so once a batch's job finished
+    the scenes of that batch that are still unorganized are shunned, and
+    retried once their retry-after expires.
 
     Returns:
-        bool:
-            True: job stats is desired status
-            False: job finished or was cancelled without matching desired status
-            None: job could not be found
+        int: number of scenes identified
     """
-    timeout_value = time.time() + timeout
-    while time.time() < timeout_value:
-        job = stash.find_job(job_id)
-        if not job:
-            return None
-        progress = (
-            job["progress"]
-            if "progress" in job and job["progress"] is not None
-            else 0.0
-        )
-        stash.log.debug(
-            f"Waiting for Job:{job_id} Status:{job['status']} Progress:{progress:.1f}"
-        )
-        if job["status"] == status:
-            return True
-        if job["status"] in ["FINISHED", "CANCELLED"]:
+    state = get_state()
+    batches = list(chunked(list(scene_ids), IDENTIFY_BATCH_SIZE))
+    concurrency = IDENTIFY_CONCURRENCY or get_parallel_tasks()
+    log.info(
+        f"Identifying {len(scene_ids)} unorganized scenes in {len(batches)} batches, {concurrency} at a time"
+    )
+
+    def identify_batch(batch_ids):
+        job_id = stash.stashbox_identify_task(batch_ids)["metadataIdentify"]
+        if not stash.wait_for_job(job_id, kind="identify"):
+            # cancelled or failed: the scenes were not necessarily attempted
+            raise RuntimeError(f"identify job {job_id} did not finish")
+        failed = [
+            scene["id"]
+            for scene in iter_scenes(stash, f={"organized": False}, scene_ids=batch_ids)
+        ]
+        state.record_identify(batch_ids, failed)
+        return len(batch_ids) - len(failed)
+
+    identified = 0
+    with ThreadPoolExecutor(concurrency, thread_name_prefix="Identify") as pool:
+        futures = [pool.submit(identify_batch, batch_ids) for batch_ids in batches]
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                identified += future.result()
+            except Exception as e:
+                log.error(f"Identify batch failed: {e}")
+            log.info(f"Identify progress: {done}/{len(batches)} batches, {identified} scenes identified")
+    return identified
+
+
+class CircuitBreaker:
+    """Stops calling a failing service for ``cooldown`` seconds after ``threshold``
+    consecutive failures, then lets a single trial call through."""
+
+    def __init__(self, threshold=AI_BREAKER_THRESHOLD, cooldown=AI_BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        return self.opened_at is None or time.monotonic() - self.opened_at >= self.cooldown
+
+    def record(self, ok):
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            if self.opened_at is None:
+                log.error(f"AI server failed {self.failures} times, pausing AI tagging for {self.cooldown:.0f}s")
+            self.opened_at = time.monotonic()
+
+
+class AITagger(threading.Thread):
+    """Feeds the scenes of the persistent AI queue to the ai_tagger plugin.
+
+    Each plugin run only sees a bounded batch: AI_TagMe is added to the batch's
+    scenes right before the "Tag Scenes" task is started and removed again
+    from the ones the plugin did not tag, so no other scene carries it. Scenes
+    already tagged AI_TagMe when the tagger starts are moved to the queue. The
+    batch size follows the measured seconds per scene of the previous runs.
+    Nothing is dispatched while the AI server's health probe fails.
+    """
+
+    def __init__(self):
+        super().__init__(daemon=True, name="AITagger")
+        self.breaker = CircuitBreaker()
+        self.seconds_per_scene = None
+        self._adopted = False
+        self._wake = threading.Event()
+
+    def wake(self):
+        self._wake.set()
+
+    def batch_size(self):
+        if not self.seconds_per_scene:
+            return AI_BATCH_MIN
+        size = int(AI_BATCH_SECONDS / self.seconds_per_scene)
+        return max(AI_BATCH_MIN, min(size, AI_BATCH_MAX))
+
+    def healthy(self):
+        if not ai_server_baseurl or not self.breaker.allow():
+            return False
+        try:
+            response = requests.get(ai_server_baseurl + AI_HEALTH_PATH, timeout=AI_HEALTH_TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            log.debug(f"AI server health check failed: {e}")
+            self.breaker.record(False)
             return False
-        time.sleep(period)
-    raise Exception("Hit timeout waiting for Job to complete")
+        return True
 
+    @staticmethod
+    def tagged_tag_me(stash, tag_me_id, scene_ids=None):
+        return [
+            scene["id"]
+            for scene in iter_scenes(
+                stash,
+                f={"tags": {"value": [tag_me_id], "modifier": "INCLUDES", "depth": 0}},
+                scene_ids=scene_ids,
+            )
+        ]
 
-def main(paths=None):
-    paths = None
-    if paths is None:
-        paths = []
-    paths = list(map(Path, paths))
-    print("Stash worker script incoming paths:", paths)
-    paths += [get_closest_parent_directory(path) for path in paths]
-    paths += [
-        str(path).replace(old, new)
-        for path in paths
-        for old, new in path_mutation.items()
-    ]
-    paths = list(map(str, paths))
-    stash = StashInterface(connection)
-    stash.wait_for_job = wait_for_job.__get__(stash, StashInterface)
+    def adopt_backlog(self, stash, tag_me_id):
+        """Queue the scenes tagged AI_TagMe outside of the tagger, e.g. by older versions."""
+        scene_ids = self.tagged_tag_me(stash, tag_me_id)
+        if scene_ids:
+            queued = get_state().enqueue_ai(scene_ids)
+            update_scene_tag(stash, scene_ids, tag_me_id, mode="REMOVE")
+            log.info(f"Moved {len(scene_ids)} AI_TagMe scenes to the AI queue ({queued} new)")
+        self._adopted = True
+
+    def dispatch(self):
+        """Tag one batch of queued scenes, returns True if another batch may be ready."""
+        state = get_state()
+        stash = get_stash()
+        tag_me_id = get_tag_id(stash, "AI_TagMe")
+        if tag_me_id is None:
+            log.error("AI_TagMe tag not found, skipping AI tagging")
+            return False
+        if not self._adopted:
+            self.adopt_backlog(stash, tag_me_id)
+        stash_metrics.AI_QUEUE.set(state.ai_backlog())
+        scene_ids = state.next_ai_batch(self.batch_size())
+        if not scene_ids or not self.healthy():
+            return False
+
+        # scenes deleted since they were queued (dedupe, UI) would fail the update
+        existing = {scene["id"] for scene in iter_scenes(stash, scene_ids=scene_ids)}
+        missing = [i for i in scene_ids if i not in existing]
+        if missing:
+            state.dequeue_ai(missing)
+            log.info(f"Dropped {len(missing)} deleted scenes from the AI queue")
+        scene_ids = [i for i in scene_ids if i in existing]
+        if not scene_ids:
+            return True
+
+        log.info(f"AI tagging {len(scene_ids)} scenes")
+        started = time.monotonic()
+        update_scene_tag(stash, scene_ids, tag_me_id)
+        try:
+            job_id = stash.run_plugin_task(plugin_id="ai_tagger", task_name="Tag Scenes")
+            ok = stash.wait_for_job(job_id, kind="ai_tagger")
+        finally:
+            # also when the run failed to start or timed out: the plugin removes
+            # AI_TagMe from the scenes it tagged, the others lose it until their
+            # next batch so later plugin runs don't pick them up, and the attempt
+            # counts so a batch that always fails is eventually given up
+            pending = set(self.tagged_tag_me(stash, tag_me_id, scene_ids))
+            if pending:
+                update_scene_tag(stash, pending, tag_me_id, mode="REMOVE")
+            dropped = state.finish_ai(
+                [i for i in scene_ids if i not in pending], pending, AI_MAX_ATTEMPTS
+            )
+            if dropped:
+                log.error(f"Giving up AI tagging of {len(dropped)} scenes: {dropped}")
+        self.breaker.record(bool(ok))
+        if ok:
+            self.seconds_per_scene = (time.monotonic() - started) / len(scene_ids)
+        return bool(ok)
+
+    def run(self):
+        while True:
+            try:
+                while self.dispatch():
+                    pass
+            except Exception as e:
+                log.error(f"AI tagging failed: {e}")
+                log.debug(traceback.format_exc())
+                self.breaker.record(False)
+            self._wake.wait(timeout=AI_IDLE_INTERVAL)
+            self._wake.clear()
+
+
+_ai_tagger = None
+
+
+def get_ai_tagger():
+    """Return the process-wide AITagger, started on first use."""
+    global _ai_tagger
+    with _clients_lock:
+        if _ai_tagger is None:
+            _ai_tagger = AITagger()
+            _ai_tagger.start()
+        return _ai_tagger
+
+
+class Batch:
+    """State shared by the pipeline stages for one set of incoming paths.
+
+    ``scene_ids`` is None for a whole-library run and is filled in by the scan
+    stage for a scoped run; an empty list means there is nothing left to do.
+    """
+
+    def __init__(self, paths=None):
+        paths = [str(path) for path in paths or []]
+        # all library roots at once is a whole-library run, not a scoped one
+        if paths and covers_library(paths):
+            paths = []
+        # files already processed at their current size/mtime need no rescan
+        self.paths = get_state().unprocessed(paths) if paths else []
+        self.scan_paths = get_scan_paths(self.paths)
+        self.scene_ids = [] if paths and not self.paths else None
+        self.stash = get_stash()
+
+    @property
+    def empty(self):
+        return self.scene_ids is not None and not self.scene_ids
+
+
+def scan_stage(batch):
+    if batch.empty:
+        return
+    stash = batch.stash
+    log.info("mapped paths: " + json.dumps(batch.scan_paths))
     log.debug("Scanning metadata")
-    scan_job = stash.metadata_scan(paths=paths)
+    scan_job = stash.metadata_scan(paths=batch.scan_paths)
+    assert stash.wait_for_job(scan_job, kind="scan")
+    if batch.scan_paths:
+        batch.scene_ids = find_scene_ids_under(stash, batch.scan_paths)
+        log.info(f"Scenes under scanned paths: {len(batch.scene_ids)}")
+
+
+def dedupe_stage(batch):
+    if batch.empty:
+        return
     log.debug("Checking for duplicates")
-    assert stash.wait_for_job(scan_job)
-    del_duplicates_main()
-    log.info("mapped paths: " + json.dumps(paths))
+    deleted = del_duplicates_main(batch.stash, batch.scene_ids)
+    if batch.scene_ids is not None and not DEDUPE_DRY_RUN:
+        deleted = set(map(str, deleted))
+        batch.scene_ids = [i for i in batch.scene_ids if i not in deleted]
 
+
+def identify_stage(batch):
+    if batch.empty:
+        return
+    stash = batch.stash
     try:
         unorganized_scene_ids = [
-            scene["id"] for scene in find_scenes(stash, f={"organized": False})
+            scene["id"]
+            for scene in iter_scenes(
+                stash, f={"organized": False}, scene_ids=batch.scene_ids
+            )
         ]
         log.info("Unorganized scenes: " + str(len(unorganized_scene_ids)))
         log.debug("Unorganized scenes: " + json.dumps(unorganized_scene_ids))
@@ -441,69 +1063,167 @@ def main(paths=None):
         log.error("Failed to get unorganized scenes" + str(e))
         unorganized_scene_ids = []
 
-    # shunned scenes (always failing)
-    if os.path.isfile("shunned_scenes.json"):
-        with open("shunned_scenes.json") as f:
-            shunned_scenes = json.load(f)
-        unorganized_scene_ids = [
-            scene_id
-            for scene_id in unorganized_scene_ids
-            if scene_id not in shunned_scenes
-        ]
+    # shunned scenes (always failing) wait out their retry-after
+    state = get_state()
+    shunned_scenes = state.shunned_ids()
+    unorganized_scene_ids = [
+        scene_id
+        for scene_id in unorganized_scene_ids
+        if scene_id not in shunned_scenes
+    ]
 
     if unorganized_scene_ids:
-        log.info("Identifying unorganized scenes")
-        # the identify task will go over all the unorganized and tries to identify them, and if successful, it will set the organized field to true
-        # later we will check if the unorganized scenes are still unorganized, if so, we will add them to the shunned scenes
-        assert stash.wait_for_job(
-            stash.stashbox_identify_task(unorganized_scene_ids)["metadataIdentify"]
-        )
-        shunned_scenes = [
+        identify_scenes(stash, unorganized_scene_ids)
+
+
+def tag_stage(batch):
+    """Queue untagged scenes for the AITagger, which tags them in the background."""
+    if batch.empty:
+        return
+    try:
+        queued = get_state().enqueue_ai(find_untagged_scenes(batch.stash, batch.scene_ids))
+        log.info(f"Queued {queued} scenes for AI tagging")
+    except Exception as e:
+        log.error("Failed to queue non AI tagged scenes: " + str(e))
+    get_ai_tagger().wake()
+
+
+def generate_stage(batch):
+    if batch.empty:
+        return
+    stash = batch.stash
+    state = get_state()
+    started = time.time()
+    scene_ids = batch.scene_ids
+    if scene_ids is None:
+        last_full = float(state.get_value("last_full_generate", 0))
+        if FULL_GENERATE_INTERVAL and started - last_full >= FULL_GENERATE_INTERVAL:
+            log.info("Generating metadata for the whole library")
+            job_id = metadata_generate()
+            if stash.wait_for_job(job_id, kind="generate_full"):
+                state.set_value("last_full_generate", started)
+                state.set_value("last_generate", started)
+            return
+        # whole-library run between full generates: only scenes added since the last generate
+        since = float(state.get_value("last_generate", last_full or started))
+        scene_ids = [
             scene["id"]
-            for scene in find_scenes(stash, f={"organized": False})
-            if scene["id"] in unorganized_scene_ids
+            for scene in iter_scenes(
+                stash,
+                f={
+                    "created_at": {
+                        "value": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(since)),
+                        "modifier": "GREATER_THAN",
+                    }
+                },
+            )
         ]
-        try:
-            with open("shunned_scenes.json", "w") as f:
-                json.dump(shunned_scenes, f, indent=4)
-        except OSError as e:
-            log.error("Failed to write shunned scenes file: " + str(e))
-            log.error(traceback.format_exc())
+    if not scene_ids:
+        log.info("No new scenes to generate metadata for")
+        if batch.scene_ids is None:
+            state.set_value("last_generate", started)
+        return
+    log.info(f"Generating metadata for {len(scene_ids)} scenes")
+    job_id = metadata_generate(scene_ids)
+    if stash.wait_for_job(job_id, kind="generate") and batch.scene_ids is None:
+        state.set_value("last_generate", started)
 
-    non_ai_tagged_scenes = [
-        scene
-        for scene in find_scenes(stash)
-        if "AI_Tagged" not in [tag["name"] for tag in scene.get("tags", [])]
-    ]
-    if non_ai_tagged_scenes:
-        try:
-            AI_TAG_ID = stash.find_tag("AI_TagMe")["id"]
-            stash.update_scenes(
-                {
-                    "ids": [x["id"] for x in non_ai_tagged_scenes],
-                    "tag_ids": {"mode": "ADD", "ids": [AI_TAG_ID]},
-                    # "organized": True
-                }
-            )
-        except Exception as e:
-            log.error("Failed to add AI_TagMe tag to non AI tagged scenes: " + str(e))
 
-    # check if ai server is running
+# Identify waits for dedupe so stash-box is never asked about scenes about to be
+# deleted; generate only needs the duplicates gone and runs alongside identify/tag.
+STAGES = [
+    Stage("scan", scan_stage),
+    Stage("dedupe", dedupe_stage, inputs=["scan"]),
+    Stage("identify", identify_stage, inputs=["dedupe"]),
+    Stage("tag", tag_stage, inputs=["identify"]),
+    Stage("generate", generate_stage, inputs=["dedupe"]),
+]
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def get_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = Pipeline(STAGES, max_batches=PIPELINE_MAX_BATCHES)
+        return _pipeline
+
+
+class WorkerLock:
+    """Cross-process lock on WORKER_LOCK_FILE, shared by the batches of this process.
+
+    The file is flock()ed while at least one batch is in flight, so another
+    process (e.g. a manual ``python stash_worker.py`` next to the container)
+    waits instead of submitting the same jobs to Stash.
+    """
+
+    def __init__(self, path=WORKER_LOCK_FILE):
+        self.path = path
+        self._holders = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if not self._holders:
+                self._file = open(self.path, "a")
+                try:
+                    fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    log.info(f"Another stash worker holds {self.path}, waiting for it")
+                    fcntl.flock(self._file, fcntl.LOCK_EX)
+            self._holders += 1
+
+    def release(self):
+        with self._lock:
+            self._holders -= 1
+            if not self._holders:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._file.close()
+                self._file = None
+
+
+_worker_lock = WorkerLock()
+
+
+def submit(paths=None):
+    """Queue a batch on the pipeline without waiting for it.
+
+    Blocks while another process holds the worker lock.
+
+    Returns:
+        Future: resolves once every stage of the batch is done
+    """
+    paths = [str(path) for path in paths or []]
+    log.debug(f"Stash worker script incoming paths: {paths}")
+    _worker_lock.acquire()
     try:
-        response = requests.get(ai_server_baseurl + "/docs", timeout=100)
-        response.raise_for_status()
-        log.info("AI Server is running :D")
-        ai_tagger_job_id = stash.run_plugin_task(
-            plugin_id="ai_tagger",
-            task_name="Tag Scenes",
-        )
-        assert stash.wait_for_job(ai_tagger_job_id)
-    except requests.RequestException as e:
-        log.error("Failed to connect to AI Server" + str(e))
+        batch = Batch(paths)
+        future = get_pipeline().submit(batch)
+    except BaseException:
+        _worker_lock.release()
+        raise
+
+    def done(finished):
+        _worker_lock.release()
+        if finished.exception() is None:
+            get_state().mark_processed([p for p in batch.paths if os.path.isfile(p)])
+
+    future.add_done_callback(done)
+    return future
 
-    log.info("Generating metadata")
-    stash.metadata_generate()
+
+def main(paths=None):
+    """Run the scan/dedupe/identify/tag/generate pipeline and wait for it.
+
+    With ``paths`` only those paths are scanned and the later stages are
+    restricted to the scenes whose files live under them. Without ``paths``
+    the whole library is processed.
+    """
+    return submit(paths).result()
 
 
 if __name__ == "__main__":
-    main(get_watch_directories())
+    main()
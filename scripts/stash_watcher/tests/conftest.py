@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+# stash_worker reads these at import time, the tests never reach a Stash server
+os.environ.setdefault("STASH_API_KEY", "test")
+os.environ.setdefault("STASH_BASE_URL", "http://stash.invalid:9999")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stash_worker  # noqa: E402
+from stash_state import StateStore  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    """Relative state files (shunned_scenes.json, caches, ...) resolve in a scratch directory."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    """A fresh StateStore used as stash_worker's process-wide state."""
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    monkeypatch.setattr(stash_worker, "_state", store)
+    return store
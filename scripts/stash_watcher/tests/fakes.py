@@ -0,0 +1,43 @@
+"""Stand-ins for the Stash server used by the worker tests."""
+
+
+class FakeStash:
+    """Answers the findScenes queries of ``stash_worker.iter_scenes``.
+
+    Args:
+        scenes (dict): scene ID -> scene
+        phash_matches (dict, optional): phash -> IDs returned by a phash_distance filter
+    """
+
+    def __init__(self, scenes, phash_matches=None):
+        self.scenes = scenes
+        self.phash_matches = phash_matches or {}
+        self.queries = []
+
+    def call_GQL(self, query, variables=None):
+        self.queries.append(variables)
+        scene_filter = variables["scene_filter"]
+        if "phash_distance" in scene_filter:
+            ids = self.phash_matches.get(scene_filter["phash_distance"]["value"], [])
+        elif variables["scene_ids"] is not None:
+            ids = [str(scene_id) for scene_id in variables["scene_ids"]]
+        else:
+            ids = list(self.scenes)
+        return {"findScenes": {"scenes": [self.scenes[i] for i in ids if i in self.scenes]}}
+
+
+def make_scene(scene_id, phash=None, size=1000, width=1920, height=1080, organized=False):
+    files = []
+    if size is not None:
+        files.append(
+            {
+                "size": size,
+                "duration": 600.0,
+                "video_codec": "h264",
+                "width": width,
+                "height": height,
+                "bit_rate": size * 8 // 600,
+                "fingerprints": [{"type": "phash", "value": phash}] if phash else [],
+            }
+        )
+    return {"id": scene_id, "organized": organized, "files": files}
@@ -0,0 +1,69 @@
+import pytest
+
+import stash_worker
+
+
+class PluginStash:
+    """Runs the ai_tagger plugin, which tags the scenes in ``tags`` or times out."""
+
+    def __init__(self, tags=(), timeout=False):
+        self.tags = set(tags)
+        self.timeout = timeout
+        self.tagged_tag_me = set()
+
+    def run_plugin_task(self, plugin_id, task_name):
+        return "1"
+
+    def wait_for_job(self, job_id, kind=None):
+        if self.timeout:
+            raise TimeoutError("job 1 did not finish")
+        self.tagged_tag_me -= self.tags
+        return True
+
+
+@pytest.fixture
+def tagger(state, monkeypatch):
+    def update_scene_tag(stash, scene_ids, tag_id, mode="ADD"):
+        if mode == "ADD":
+            stash.tagged_tag_me |= set(scene_ids)
+        else:
+            stash.tagged_tag_me -= set(scene_ids)
+
+    def tagged_tag_me(stash, tag_me_id, scene_ids=None):
+        return [i for i in scene_ids if i in stash.tagged_tag_me]
+
+    monkeypatch.setattr(stash_worker, "get_tag_id", lambda stash, name: "99")
+    monkeypatch.setattr(stash_worker, "update_scene_tag", update_scene_tag)
+    monkeypatch.setattr(
+        stash_worker, "iter_scenes", lambda stash, scene_ids: [{"id": i} for i in scene_ids]
+    )
+    monkeypatch.setattr(stash_worker.AITagger, "tagged_tag_me", staticmethod(tagged_tag_me))
+    monkeypatch.setattr(stash_worker.AITagger, "healthy", lambda self: True)
+    monkeypatch.setattr(stash_worker, "AI_MAX_ATTEMPTS", 2)
+    tagger = stash_worker.AITagger()
+    tagger._adopted = True
+    return tagger
+
+
+def test_untagged_scenes_lose_tag_me_and_count_an_attempt(tagger, state, monkeypatch):
+    stash = PluginStash(tags=["1"])
+    monkeypatch.setattr(stash_worker, "get_stash", lambda: stash)
+    state.enqueue_ai(["1", "2"])
+
+    assert tagger.dispatch()
+    assert stash.tagged_tag_me == set()
+    assert state.next_ai_batch(10) == ["2"]
+
+
+def test_timed_out_batch_loses_tag_me_and_is_given_up(tagger, state, monkeypatch):
+    stash = PluginStash(timeout=True)
+    monkeypatch.setattr(stash_worker, "get_stash", lambda: stash)
+    state.enqueue_ai(["1"])
+
+    for _ in range(2):
+        with pytest.raises(TimeoutError):
+            tagger.dispatch()
+        assert stash.tagged_tag_me == set()
+
+    assert state.ai_backlog() == 0
+    assert state.enqueue_ai(["1"]) == 0
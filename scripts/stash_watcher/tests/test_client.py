@@ -0,0 +1,65 @@
+import pytest
+
+from stash_client import GraphQLClient, GraphQLError, register_operation
+
+QUERY = register_operation("ClientTestQuery", "query ClientTestQuery { version }")
+MUTATION = register_operation(
+    "ClientTestDestroy", "mutation ClientTestDestroy { scenesDestroy(input: {}) }"
+)
+ERROR = {"errors": [{"message": "input: scene not found"}]}
+NOT_FOUND = {"errors": [{"message": "PersistedQueryNotFound"}]}
+OK = {"data": {"ok": True}}
+
+
+class ScriptedClient(GraphQLClient):
+    """Answers the requests from ``responses`` in order and records the payloads."""
+
+    def __init__(self, *responses):
+        super().__init__("http://stash.invalid:9999", "test")
+        self.responses = list(responses)
+        self.sent = []
+
+    def _post(self, payload, idempotent=True):
+        self.sent.append(dict(payload))
+        return self.responses.pop(0)
+
+
+def test_mutation_is_not_resent_after_an_execution_error():
+    client = ScriptedClient(OK, OK, OK, ERROR)
+    client.execute(QUERY)
+    client.execute(QUERY)  # hash-only, confirms persisted queries work
+    client.execute(MUTATION)
+
+    with pytest.raises(GraphQLError):
+        client.execute(MUTATION)
+    assert "query" not in client.sent[-1]
+    assert len(client.sent) == 4
+
+
+def test_unknown_hash_is_resent_with_the_query():
+    client = ScriptedClient(OK, OK, OK, NOT_FOUND, OK)
+    client.execute(QUERY)
+    client.execute(QUERY)
+    client.execute(MUTATION)
+
+    assert client.execute(MUTATION) == {"ok": True}
+    assert "query" in client.sent[-1]
+    assert client._apq
+
+
+def test_mutation_is_sent_in_full_until_persisted_queries_work():
+    client = ScriptedClient(OK, OK)
+    client.execute(MUTATION)
+    client.execute(MUTATION)
+
+    assert all("query" in payload for payload in client.sent)
+
+
+def test_failing_hash_only_query_disables_persisted_queries():
+    client = ScriptedClient(OK, ERROR, OK, OK)
+    client.execute(QUERY)
+
+    assert client.execute(QUERY) == {"ok": True}
+    assert not client._apq
+    client.execute(QUERY)
+    assert "extensions" not in client.sent[-1]
@@ -0,0 +1,67 @@
+import pytest
+
+import stash_worker
+from stash_client import GraphQLError
+
+
+@pytest.fixture
+def destroyed(monkeypatch):
+    """Scene ID chunks passed to destroy_scenes, chunks containing a "bad" ID fail."""
+    calls = []
+
+    def destroy_scenes(ids):
+        calls.append(list(ids))
+        if "bad" in ids:
+            raise GraphQLError("ScenesDestroy", [{"message": "boom"}])
+
+    monkeypatch.setattr(stash_worker, "destroy_scenes", destroy_scenes)
+    monkeypatch.setattr(stash_worker, "DELETE_MAX_BYTES_PER_SEC", 0)
+    monkeypatch.setattr(stash_worker, "DELETE_CHUNK_SIZE", 2)
+    return calls
+
+
+def test_deletions_are_chunked(state, destroyed):
+    deleted = stash_worker.delete_scene_ids(["1", "2", "3"])
+
+    assert deleted == ["1", "2", "3"]
+    assert destroyed == [["1", "2"], ["3"]]
+    assert state.pending_deletions() == []
+
+
+def test_overflow_stays_journaled_for_the_next_run(state, destroyed, monkeypatch):
+    monkeypatch.setattr(stash_worker, "DELETE_MAX_PER_RUN", 4)
+
+    assert stash_worker.delete_scene_ids(["1", "2", "3", "4", "5", "6"]) == ["1", "2", "3", "4"]
+    assert state.pending_deletion_ids() == {"5", "6"}
+
+    # a later (e.g. scoped) run finds the rest in the journal
+    assert stash_worker.delete_scene_ids([]) == ["5", "6"]
+    assert state.pending_deletions() == []
+
+
+def test_journaled_scenes_are_not_journaled_twice(state, destroyed, monkeypatch):
+    monkeypatch.setattr(stash_worker, "DELETE_MAX_PER_RUN", 2)
+    stash_worker.delete_scene_ids(["1", "2", "3", "4"])
+
+    # the same duplicates are found again before the overflow was deleted
+    stash_worker.delete_scene_ids(["3", "4", "5"])
+
+    assert destroyed == [["1", "2"], ["3", "4"]]
+    assert [ids for _, ids, _ in state.pending_deletions()] == [["5"]]
+
+
+def test_failed_chunk_is_retried_then_given_up(state, destroyed, monkeypatch):
+    monkeypatch.setattr(stash_worker, "DELETE_MAX_ATTEMPTS", 2)
+
+    assert stash_worker.delete_scene_ids(["bad", "1", "2"]) == ["2"]
+    assert state.pending_deletion_ids() == {"bad", "1"}
+
+    assert stash_worker.run_pending_deletions() == []
+    assert state.pending_deletions() == []
+    assert destroyed == [["bad", "1"], ["2"], ["bad", "1"]]
+
+
+def test_interrupted_run_is_resumed(state, destroyed):
+    state.journal_deletions([(["7", "8"], 10)])
+
+    assert stash_worker.run_pending_deletions() == ["7", "8"]
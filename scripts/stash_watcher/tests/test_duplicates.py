@@ -0,0 +1,89 @@
+import stash_worker
+from fakes import FakeStash, make_scene
+
+
+def ids(groups):
+    return [sorted(scene["id"] for scene in group) for group in groups]
+
+
+def test_find_duplicate_groups_never_reuses_a_scene():
+    # A~C and B~C, but A and B are not duplicates of each other
+    scenes = {
+        "1": make_scene("1", phash="a"),
+        "2": make_scene("2", phash="b"),
+        "3": make_scene("3", phash="c"),
+    }
+    stash = FakeStash(scenes, {"a": ["1", "3"], "b": ["2", "3"], "c": ["1", "2", "3"]})
+
+    groups = stash_worker.find_duplicate_groups(stash, ["1", "2"])
+
+    assert ids(groups) == [["1", "3"]]
+
+
+def test_find_duplicate_groups_queries_each_phash_once():
+    scenes = {
+        "1": make_scene("1", phash="a"),
+        "2": make_scene("2", phash="a"),
+        "3": make_scene("3", phash="z"),
+    }
+    stash = FakeStash(scenes, {"a": ["1", "2"], "z": ["3"]})
+
+    groups = stash_worker.find_duplicate_groups(stash, ["1", "2", "3"])
+
+    assert ids(groups) == [["1", "2"]]
+    phash_queries = [q for q in stash.queries if "phash_distance" in q["scene_filter"]]
+    assert [q["scene_filter"]["phash_distance"]["value"] for q in phash_queries] == ["a", "z"]
+
+
+def test_disjoint_groups():
+    a, b, c, d = (make_scene(i) for i in "abcd")
+
+    assert ids(stash_worker.disjoint_groups([[a, c], [b, c], [b, d]])) == [["a", "c"], ["b", "d"]]
+
+
+def test_score_duplicates_prefers_better_file_and_skips_scenes_without_files():
+    low = make_scene("low", size=500, width=1280, height=720)
+    high = make_scene("high", size=2000)
+    empty = make_scene("empty", size=None)
+
+    scored = stash_worker.score_duplicates([low, empty, high])
+
+    assert [scene["id"] for _, scene in scored] == ["high", "low"]
+    assert stash_worker.score_duplicates([empty]) == []
+
+
+def test_score_duplicates_breaks_ties_by_size():
+    small = make_scene("small", size=1000)
+    large = make_scene("large", size=1000)
+    large["files"][0]["size"] = 1001
+    weights = {"organized": 1}
+
+    scored = stash_worker.score_duplicates([small, large], weights=weights)
+
+    assert scored[0][1]["id"] == "large"
+
+
+def test_del_duplicates_main_dry_run_deletes_nothing(state, monkeypatch):
+    destroyed = []
+    monkeypatch.setattr(stash_worker, "destroy_scenes", destroyed.append)
+    scenes = {"1": make_scene("1", phash="a", size=500), "2": make_scene("2", phash="a")}
+    stash = FakeStash(scenes, {"a": ["1", "2"]})
+
+    assert stash_worker.del_duplicates_main(stash, ["1"], dry_run=True) == ["1"]
+    assert destroyed == []
+    assert state.pending_deletions() == []
+
+
+def test_del_duplicates_main_keeps_the_best_scene(state, monkeypatch):
+    destroyed = []
+    monkeypatch.setattr(stash_worker, "destroy_scenes", destroyed.append)
+    monkeypatch.setattr(stash_worker, "DELETE_MAX_BYTES_PER_SEC", 0)
+    scenes = {
+        "1": make_scene("1", phash="a", size=500),
+        "2": make_scene("2", phash="a"),
+        "3": make_scene("3", phash="a", size=None),
+    }
+    stash = FakeStash(scenes, {"a": ["1", "2", "3"]})
+
+    assert stash_worker.del_duplicates_main(stash, ["1"], dry_run=False) == ["1"]
+    assert destroyed == [["1"]]
@@ -0,0 +1,60 @@
+import json
+import sqlite3
+
+import stash_state
+from stash_state import StateStore
+
+
+def test_legacy_shunned_file_is_imported_once(tmp_path, monkeypatch):
+    legacy = tmp_path / "shunned_scenes.json"
+    legacy.write_text(json.dumps(["1", "2"]))
+    monkeypatch.setattr(stash_state, "LEGACY_SHUNNED_FILE", str(legacy))
+    db = str(tmp_path / "state.sqlite3")
+
+    store = StateStore(db)
+    assert store.shunned_ids() == {"1", "2"}
+    assert not legacy.exists()
+
+    # forgiving every scene empties the table, a stale file must not come back
+    store.record_identify(["1", "2"], [])
+    legacy.write_text(json.dumps(["1"]))
+    assert StateStore(db).shunned_ids() == set()
+
+
+def test_deletions_table_is_migrated(tmp_path):
+    db = str(tmp_path / "state.sqlite3")
+    conn = sqlite3.connect(db)
+    conn.execute(
+        "CREATE TABLE deletions (chunk_id INTEGER PRIMARY KEY AUTOINCREMENT, scene_ids TEXT NOT NULL,"
+        " bytes INTEGER NOT NULL, status TEXT NOT NULL, created_at REAL NOT NULL, finished_at REAL)"
+    )
+    conn.execute("INSERT INTO deletions VALUES (1, '[\"5\"]', 0, 'pending', 0, NULL)")
+    conn.commit()
+    conn.close()
+
+    store = StateStore(db)
+
+    assert store.retry_deletion(1, max_attempts=2) is False
+    assert store.pending_deletion_ids() == {"5"}
+    assert store.retry_deletion(1, max_attempts=2) is True
+    assert store.pending_deletions() == []
+
+
+def test_ai_queue_drops_scenes_after_max_attempts(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    assert store.enqueue_ai(["1", "2", "3"]) == 3
+    assert store.enqueue_ai(["3"]) == 0
+
+    assert store.finish_ai(["1"], ["2", "3"], max_attempts=2) == []
+    assert store.next_ai_batch(10) == ["2", "3"]
+    assert sorted(store.finish_ai([], ["2", "3"], max_attempts=2)) == ["2", "3"]
+    assert store.ai_backlog() == 0
+
+
+def test_given_up_scenes_are_not_queued_again(tmp_path):
+    store = StateStore(str(tmp_path / "state.sqlite3"))
+    store.enqueue_ai(["1", "2"])
+
+    assert store.finish_ai([], ["1"], max_attempts=1) == ["1"]
+    assert store.enqueue_ai(["1", "2", "3"]) == 1
+    assert sorted(store.next_ai_batch(10)) == ["2", "3"]
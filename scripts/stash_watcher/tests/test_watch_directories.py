@@ -0,0 +1,36 @@
+import json
+
+import stash_worker
+
+
+class ConfigClient:
+    def __init__(self, *paths):
+        self.stashes = [{"path": p, "excludeVideo": False, "excludeImage": False} for p in paths]
+        self.calls = 0
+
+    def execute(self, operation, variables=None):
+        self.calls += 1
+        return {"configuration": {"general": {"stashes": self.stashes}}}
+
+
+def test_worker_reads_the_cached_paths_without_asking_stash(monkeypatch):
+    client = ConfigClient("/data")
+    monkeypatch.setattr(stash_worker, "get_client", lambda: client)
+
+    assert stash_worker.get_watch_directories() == ["/data"]
+    assert stash_worker.get_watch_directories() == ["/data"]
+    assert client.calls == 1
+
+
+def test_fetch_reports_a_config_change(monkeypatch):
+    client = ConfigClient("/data")
+    monkeypatch.setattr(stash_worker, "get_client", lambda: client)
+    paths, digest = stash_worker.fetch_watch_directories()
+
+    # a worker run in between must not hide the change from the watcher
+    stash_worker.get_watch_directories()
+    client.stashes.append({"path": "/more", "excludeVideo": False, "excludeImage": True})
+
+    assert stash_worker.fetch_watch_directories()[1] != digest
+    with open(stash_worker.WATCH_DIRS_CACHE_FILE) as f:
+        assert json.load(f) == {"paths": ["/data", "/more"]}
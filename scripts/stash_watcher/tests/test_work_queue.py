@@ -0,0 +1,143 @@
+import os
+import threading
+from concurrent.futures import Future
+
+import pytest
+
+import stash_watcher
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class FakeRuns:
+    def __init__(self):
+        self.requested = []
+        self.flushed = threading.Event()
+
+    def request(self, paths):
+        self.requested.append(paths)
+        self.flushed.set()
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(stash_watcher, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def queue(clock):
+    return stash_watcher.WorkQueue(FakeRuns(), quiet=30, max_wait=600, stable=60)
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = tmp_path / "scene.mp4"
+    path.write_bytes(b"x" * 10)
+    return str(path)
+
+
+def test_events_are_coalesced_and_debounced(queue, clock, video):
+    for _ in range(5):
+        queue.submit(video, closed=True)
+        clock.now += 10
+
+    assert queue.events == 5
+    assert queue.busy
+    paths, wait = queue._take_ready()
+    assert paths is None and wait == pytest.approx(20)
+
+    clock.now += 20
+    assert queue._take_ready() == ([video], None)
+    assert not queue.busy
+
+
+def test_steady_events_are_flushed_after_max_wait(queue, clock, video):
+    while clock.now < 1000 + 600:
+        queue.submit(video, closed=True)
+        assert queue._take_ready()[0] is None
+        clock.now += 20
+
+    assert queue._take_ready() == ([video], None)
+
+
+def test_file_still_being_written_stays_pending(queue, clock, video):
+    queue.submit(video)
+    clock.now += 30
+    paths, wait = queue._take_ready()
+    assert paths is None and wait == pytest.approx(60)
+
+    # it grows: the stability window restarts
+    with open(video, "ab") as f:
+        f.write(b"more")
+    clock.now += 50
+    paths, wait = queue._take_ready()
+    assert paths is None and wait == pytest.approx(60)
+
+    clock.now += 60
+    assert queue._take_ready() == ([video], None)
+
+
+def test_close_write_releases_the_file(queue, clock, video):
+    queue.submit(video)
+    queue.submit(video, closed=True)
+    clock.now += 30
+
+    assert queue._take_ready() == ([video], None)
+
+
+def test_rewritten_file_waits_again_after_close_write(queue, clock, video):
+    queue.submit(video, closed=True)
+    with open(video, "ab") as f:
+        f.write(b"more")
+    clock.now += 30
+
+    paths, wait = queue._take_ready()
+    assert paths is None and wait == pytest.approx(60)
+
+
+def test_vanished_file_is_released(queue, clock, video):
+    queue.submit(video)
+    os.remove(video)
+    clock.now += 30
+
+    assert queue._take_ready() == ([video], None)
+
+
+def test_only_stable_paths_are_flushed(queue, clock, tmp_path, video):
+    growing = str(tmp_path / "growing.mp4")
+    open(growing, "w").close()
+    queue.submit(video, closed=True)
+    queue.submit(growing)
+    clock.now += 30
+
+    assert queue._take_ready() == ([video], None)
+    assert queue.busy
+
+
+def test_run_flushes_one_batch(video):
+    runs = FakeRuns()
+    queue = stash_watcher.WorkQueue(runs, quiet=0.05, max_wait=1, stable=60)
+    other = video + ".nfo"
+    open(other, "w").close()
+    queue.start()
+    try:
+        queue.submit(video, closed=True)
+        queue.submit(other, closed=True)
+        assert runs.flushed.wait(timeout=5)
+    finally:
+        queue.stop()
+        queue.join(timeout=5)
+
+    assert runs.requested == [sorted([video, other])]
+    assert not queue.busy
@@ -0,0 +1,246 @@
+#!/usr/bin/python3
+"""Pure logic of the StashDB favorites sync, importable without side effects.
+
+Snapshot and diff of the synced favorites, and the StashApp lookup index used
+to find the StashApp entity of a StashDB favorite. The sync script does the
+network I/O and feeds them.
+"""
+
+import hashlib
+import json
+import math
+import os
+import re
+import unicodedata
+
+from loguru import logger
+
+## Snapshot of the last sync, only the delta of the favorites is synced downstream
+
+SYNC_SNAPSHOT_FILE = os.environ.get("SYNC_SNAPSHOT_FILE", "sync_snapshot.json")
+# Ignore the snapshot and re-apply every favorite
+SYNC_FULL = os.environ.get("SYNC_FULL", "").lower() in ("1", "true", "yes")
+
+
+# Only the fields the downstream stages use, other StashDB edits (images,
+# measurements, `updated`, ...) don't make a favorite "changed"
+SYNC_HASH_FIELDS = ("name", "disambiguation")
+
+
+def content_hash(entity: dict) -> str:
+    synced = {field: entity.get(field) for field in SYNC_HASH_FIELDS}
+    synced["aliases"] = sorted(entity.get("aliases") or [])
+    synced["urls"] = sorted(url["url"] for url in entity.get("urls") or [])
+    return hashlib.sha256(json.dumps(synced, sort_keys=True).encode()).hexdigest()
+
+
+def load_sync_snapshot() -> dict:
+    """Last synced favorites as {"studios": {id: entry}, "performers": {id: entry}}"""
+    snapshot = {"studios": {}, "performers": {}}
+    if SYNC_FULL:
+        return snapshot
+    try:
+        with open(SYNC_SNAPSHOT_FILE, "r") as f:
+            snapshot.update(json.load(f))
+    except (ValueError, IOError) as e:
+        logger.warning(f"No usable sync snapshot ({e}), syncing every favorite")
+    return snapshot
+
+
+def save_sync_snapshot(snapshot: dict):
+    tmp = SYNC_SNAPSHOT_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(snapshot, f)
+    os.replace(tmp, SYNC_SNAPSHOT_FILE)
+
+
+class FavoritesDiff:
+    """Classifies favorites against their snapshot entries while they stream in.
+
+    :meth:`feed` passes through the added and changed entities, so downstream
+    stages can start on them before the last page arrived; ``removed`` is only
+    complete once the stream was consumed.
+    """
+
+    def __init__(self, previous: dict):
+        self.previous = previous
+        self.current = []
+        self.added = []
+        self.changed = []
+        self.unchanged = []
+
+    def feed(self, entities):
+        for entity in entities:
+            self.current.append(entity)
+            entry = self.previous.get(entity["id"])
+            if entry is None:
+                self.added.append(entity)
+            elif entry["hash"] != content_hash(entity):
+                self.changed.append(entity)
+            else:
+                self.unchanged.append(entity)
+                continue
+            yield entity
+
+    @property
+    def to_sync(self) -> list:
+        return self.added + self.changed
+
+    @property
+    def stashapp_pending(self) -> list:
+        """Unchanged favorites that had no StashApp entity on the last sync"""
+        return [
+            entity
+            for entity in self.unchanged
+            if self.previous[entity["id"]].get("stashapp") is False
+        ]
+
+    @property
+    def removed(self) -> list:
+        """Snapshot entries (with their id) of the favorites that are gone"""
+        current_ids = {entity["id"] for entity in self.current}
+        return [
+            dict(entry, id=id)
+            for id, entry in self.previous.items()
+            if id not in current_ids
+        ]
+
+    def summary(self, kind: str) -> str:
+        return (
+            f"Favorite {kind}: {len(self.added)} added, {len(self.changed)} changed, "
+            f"{len(self.removed)} removed, {len(self.unchanged)} unchanged"
+        )
+
+
+## Lookup of the StashApp entity of a StashDB favorite
+
+# Name matches below this confidence are not used
+SYNC_MATCH_MIN_CONFIDENCE = float(os.environ.get("SYNC_MATCH_MIN_CONFIDENCE", 0.85))
+# A fuzzy match must beat the runner-up by this much, otherwise it is ambiguous
+SYNC_MATCH_MARGIN = float(os.environ.get("SYNC_MATCH_MARGIN", 0.05))
+
+
+def normalize_name(name: str) -> str:
+    """Casefolded, diacritics stripped, punctuation removed, single spaces"""
+    name = unicodedata.normalize("NFKD", name or "")
+    name = "".join(c for c in name if not unicodedata.combining(c)).casefold()
+    return " ".join(re.findall(r"\w+", name))
+
+
+def trigrams(normalized: str) -> set:
+    padded = f"  {normalized} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class StashAppIndex:
+    """In-memory lookup of StashApp performers or studios by StashDB ID, and by
+    normalized name, alias or trigram similarity for entities not linked yet"""
+
+    def __init__(self, kind: str, entities: list):
+        self.kind = kind
+        self.entities = entities
+        self.by_stash_id = {}
+        self.by_name = {}  # normalized name -> entities
+        self.by_alias = {}  # normalized alias -> entities
+        self.by_trigram = {}  # trigram -> normalized names and aliases
+        self.trigram_sets = {}  # normalized name or alias -> its trigrams
+        for entity in self.entities:
+            for stash_id in entity["stash_ids"]:
+                self.by_stash_id.setdefault(stash_id["stash_id"], []).append(entity)
+            # entities linked to another StashDB entity are never name matches
+            if any("stashdb.org" in x["endpoint"] for x in entity["stash_ids"]):
+                continue
+            name = normalize_name(entity["name"])
+            self.by_name.setdefault(name, []).append(entity)
+            aliases = entity.get("alias_list") or entity.get("aliases") or []
+            for alias in {normalize_name(alias) for alias in aliases} - {name}:
+                self.by_alias.setdefault(alias, []).append(entity)
+        for normalized in set(self.by_name) | set(self.by_alias):
+            self.trigram_sets[normalized] = trigrams(normalized)
+            for trigram in self.trigram_sets[normalized]:
+                self.by_trigram.setdefault(trigram, set()).add(normalized)
+        logger.info(
+            f"Indexed {len(self.entities)} StashApp {kind}, {len(self.by_stash_id)} with stash IDs"
+        )
+
+    def find(self, stashdb_id: str) -> list:
+        return self.by_stash_id.get(stashdb_id, [])
+
+    def _named(self, normalized: str) -> list:
+        return self.by_name.get(normalized, []) + self.by_alias.get(normalized, [])
+
+    @staticmethod
+    def _contradicts(entity: dict, disambiguation: str) -> bool:
+        """Both sides are disambiguated, differently"""
+        other = normalize_name(entity.get("disambiguation"))
+        return bool(disambiguation and other and other != normalize_name(disambiguation))
+
+    def _disambiguate(self, candidates: list, disambiguation: str) -> list:
+        """Drop candidates the StashDB disambiguation rules out, prefer those it names"""
+        unique = list({x["id"]: x for x in candidates}.values())
+        if disambiguation:
+            wanted = normalize_name(disambiguation)
+            unique = [x for x in unique if not self._contradicts(x, disambiguation)]
+            unique = [
+                x for x in unique if normalize_name(x.get("disambiguation")) == wanted
+            ] or unique
+        return unique
+
+    def _similar(self, query: str, threshold: float) -> dict:
+        """Normalized names and aliases with a trigram Jaccard similarity of at least
+        ``threshold`` to ``query``, with their similarity"""
+        query_trigrams = trigrams(query)
+        size = len(query_trigrams)
+        # a match shares at least ceil(threshold * size) trigrams with the query, so
+        # it has one of its `size - that + 1` rarest trigrams (prefix filtering)
+        rarest = sorted(query_trigrams, key=lambda t: len(self.by_trigram.get(t, ())))
+        prefix = rarest[: size - math.ceil(threshold * size) + 1]
+        scores = {}
+        for normalized in set().union(*(self.by_trigram.get(t, ()) for t in prefix)):
+            other = self.trigram_sets[normalized]
+            # |A & B| / |A | B| can't reach threshold when the sizes are too far apart
+            if not threshold * size <= len(other) <= size / threshold:
+                continue
+            common = len(query_trigrams & other)
+            score = common / (size + len(other) - common)
+            if score >= threshold:
+                scores[normalized] = score
+        return scores
+
+    def match(self, name: str, aliases=(), disambiguation: str = None):
+        """Best StashApp entity for a StashDB name and its aliases.
+
+        Returns:
+            tuple: (entity, confidence, how) or (None, confidence, reason)
+        """
+        name = normalize_name(name)
+        aliases = [a for a in {normalize_name(a) for a in aliases} if a and a != name]
+        ranked = [
+            (1.0, "name", self.by_name.get(name, [])),
+            (0.95, "alias", self.by_alias.get(name, [])),
+            (0.9, "alias", [x for a in aliases for x in self._named(a)]),
+        ]
+        for confidence, how, candidates in ranked:
+            candidates = self._disambiguate(candidates, disambiguation)
+            if len(candidates) == 1:
+                return candidates[0], confidence, how
+            if candidates:
+                return None, confidence / len(candidates), f"{len(candidates)} {how} matches"
+
+        # trigram (Jaccard) similarity; below the threshold a match is either
+        # rejected or can't be the runner-up making the best one ambiguous
+        threshold = max(SYNC_MATCH_MIN_CONFIDENCE - SYNC_MATCH_MARGIN, 0.01)
+        scores = {}
+        for query in [name, *aliases]:
+            for normalized, score in self._similar(query, threshold).items():
+                for entity in self._named(normalized):
+                    if self._contradicts(entity, disambiguation):
+                        continue
+                    if score > scores.get(entity["id"], (0.0, None))[0]:
+                        scores[entity["id"]] = (score, entity)
+        best = sorted(scores.values(), key=lambda x: x[0], reverse=True)[:2]
+        if not best:
+            return None, 0.0, "no candidates"
+        if len(best) > 1 and best[0][0] - best[1][0] < SYNC_MATCH_MARGIN:
+            return None, best[0][0], f"ambiguous with {best[1][1]['name']}"
+        return best[0][1], best[0][0], "trigram"
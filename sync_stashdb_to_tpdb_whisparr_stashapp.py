@@ -24,7 +24,8 @@ packages = [
     "python-dotenv",
     "tqdm",
     "ipywidgets",
-    "bs4"
+    "bs4",
+    "aiohttp",
 ]
 
 try:
@@ -35,9 +36,13 @@ except subprocess.CalledProcessError as e:
     print(f"Failed to install packages: {e}")
     raise
 
+import asyncio
+import time
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from multiprocessing.pool import ThreadPool
 
+import aiohttp
 import backoff
 import requests
 import stashapi.log as log
@@ -61,6 +66,16 @@ from tqdm.auto import tqdm
 # load_dotenv("..")
 assert load_dotenv()
 
+# sync_favorites reads its settings from the environment loaded above
+from sync_favorites import (
+    SYNC_MATCH_MIN_CONFIDENCE,
+    FavoritesDiff,
+    StashAppIndex,
+    content_hash,
+    load_sync_snapshot,
+    save_sync_snapshot,
+)
+
 WHISPARR_API_KEY = os.environ["WHISPARR_API_KEY"]
 WHISPARR_BASE_URL = os.environ["WHISPARR_BASE_URL"]
 
@@ -217,7 +232,23 @@ def requests_post(
 
 
 # %%
-## Get favorite studios from StashDB
+## Snapshot of the last sync, only the delta of the favorites is synced downstream
+
+sync_snapshot = load_sync_snapshot()
+# entities whose downstream sync failed stay out of the snapshot and are retried next run
+sync_failures = {"studios": set(), "performers": set()}
+
+
+# %%
+## Stream favorite studios and performers from StashDB
+#
+# The first page returns the count of the favorites, the remaining pages are
+# then fetched concurrently. Pages are not cached across runs: (un)favoriting
+# doesn't change anything a cheap probe could key a cache on. Pages are sorted
+# by creation date to stay stable while walking.
+
+STASHDB_PER_PAGE = int(os.environ.get("STASHDB_PER_PAGE", 250))
+STASHDB_WORKERS = int(os.environ.get("STASHDB_WORKERS", 4))
 
 stashdb_favorite_studios_payload = {
     "operationName": "Studios",
@@ -226,30 +257,15 @@ stashdb_favorite_studios_payload = {
             "names": "",
             "is_favorite": True,
             "page": 1,
-            "per_page": 1000,
+            "per_page": STASHDB_PER_PAGE,
             "direction": "ASC",
-            "sort": "NAME",
+            "sort": "CREATED_AT",
         }
     },
     "query": "query Studios($input: StudioQueryInput!) {\n  queryStudios(input: $input) {\n    count\n    studios {\n      id\n      name\n      deleted\n      parent {\n        id\n        name\n        __typename\n      }\n      urls {\n        ...URLFragment\n        __typename\n      }\n      images {\n        ...ImageFragment\n        __typename\n      }\n      is_favorite\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment URLFragment on URL {\n  url\n  site {\n    id\n    name\n    icon\n    __typename\n  }\n  __typename\n}\n\nfragment ImageFragment on Image {\n  id\n  url\n  width\n  height\n  __typename\n}",
 }
 
 
-data = requests.post(
-    "https://stashdb.org/graphql",
-    headers=stashdb_headers,
-    json=stashdb_favorite_studios_payload,
-).json()
-print("data", data)
-stashdb_favorite_studios = [x for x in data["data"]["queryStudios"]["studios"]]
-print([x["name"] for x in stashdb_favorite_studios])
-
-print("stashdb favorite studios", len(stashdb_favorite_studios))
-
-
-# %%
-
-## Get favorite performers from StashDB
 stashdb_favorite_performers_payload = {
     "operationName": "Performers",
     "variables": {
@@ -257,24 +273,62 @@ stashdb_favorite_performers_payload = {
             "names": "",
             "is_favorite": True,
             "page": 1,
-            "per_page": 5000,
-            "sort": "NAME",
+            "per_page": STASHDB_PER_PAGE,
+            "sort": "CREATED_AT",
             "direction": "ASC",
         },
     },
     "query": "query Performers($input: PerformerQueryInput!) {\n  queryPerformers(input: $input) {\n    count\n    performers {\n      id\n      name\n      disambiguation\n      deleted\n      aliases\n      gender\n      birth_date\n      age\n      height\n      hair_color\n      eye_color\n      ethnicity\n      country\n      career_end_year\n      career_start_year\n      breast_type\n      waist_size\n      hip_size\n      band_size\n      cup_size\n      tattoos {\n        location\n        description\n        __typename\n      }\n      piercings {\n        location\n        description\n        __typename\n      }\n      urls {\n        ...URLFragment\n        __typename\n      }\n      images {\n        ...ImageFragment\n        __typename\n      }\n      is_favorite\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment URLFragment on URL {\n  url\n  site {\n    id\n    name\n    icon\n    __typename\n  }\n  __typename\n}\n\nfragment ImageFragment on Image {\n  id\n  url\n  width\n  height\n  __typename\n}",
 }
 
-response = requests.post(
-    "https://stashdb.org/graphql",
-    headers=stashdb_headers,
-    json=stashdb_favorite_performers_payload,
+stashdb_favorites_payloads = {
+    "studios": ("queryStudios", stashdb_favorite_studios_payload),
+    "performers": ("queryPerformers", stashdb_favorite_performers_payload),
+}
+
+
+@backoff.on_exception(
+    backoff.expo,
+    (requests.exceptions.RequestException, requests.exceptions.HTTPError),
+    max_tries=5,
+    jitter=None,
 )
-data = response.json()
-stashdb_favorite_performers = [x for x in data["data"]["queryPerformers"]["performers"]]
-len(stashdb_favorite_performers)
+def stashdb_favorites_page(kind: str, input: dict) -> dict:
+    field, payload = stashdb_favorites_payloads[kind]
+    json_data = dict(payload, variables={"input": dict(payload["variables"]["input"], **input)})
+    response = requests.post(
+        "https://stashdb.org/graphql", headers=stashdb_headers, json=json_data
+    )
+    response.raise_for_status()
+    data = response.json()
+    if data.get("errors"):
+        raise requests.exceptions.RequestException(f"StashDB {kind}: {data['errors']}")
+    return data["data"][field]
+
+
+def iter_stashdb_favorites(kind: str, per_page: int = STASHDB_PER_PAGE):
+    """Yield the favorite ``kind`` ("studios" or "performers") page by page as they arrive"""
+    first = stashdb_favorites_page(kind, {"page": 1, "per_page": per_page})
+    count = first["count"]
+    pages = (count + per_page - 1) // per_page
+    logger.info(f"StashDB favorite {kind}: {count} in {pages} pages")
+    yield from first[kind]
+    with ThreadPoolExecutor(STASHDB_WORKERS) as pool:
+        futures = [
+            pool.submit(
+                stashdb_favorites_page, kind, {"page": page, "per_page": per_page}
+            )
+            for page in range(2, pages + 1)
+        ]
+        for future in as_completed(futures):
+            yield from future.result()[kind]
+
 
-print("stashdb favorite performers", len(stashdb_favorite_performers))
+# Lazy streams: each is consumed by the first downstream stage that needs it
+studios_diff = FavoritesDiff(sync_snapshot["studios"])
+stashdb_studios_to_sync = studios_diff.feed(iter_stashdb_favorites("studios"))
+performers_diff = FavoritesDiff(sync_snapshot["performers"])
+stashdb_performers_to_sync = performers_diff.feed(iter_stashdb_favorites("performers"))
 
 
 # %%
@@ -334,94 +388,235 @@ example_response_studio_when_searching_in_whisparr = {
 whisparr = SonarrAPI(WHISPARR_BASE_URL, whisparr_headers["X-Api-Key"])
 
 
-def update_studio_on_whisparr(studio_id: int):
-    # Get current series data
-    series = whisparr.get_series(studio_id)
-
-    # Update monitoring options
-    series["monitored"] = True
-    series["monitorNewItems"] = "all"
-    series["seasons"] = [
-        {"monitored": True, "seasonNumber": season["seasonNumber"]}
-        for season in series.get("seasons", [])
-    ]
-    # Get all episodes for this series
-    episodes = whisparr.get_episode(series["id"], series=True)
-
-    # Update all episodes to be monitored
-    updated = whisparr.upd_series(data=series)
-    episode_ids = [ep["id"] for ep in episodes if not ep.get("monitored", False)]
-    whisparr.upd_episode_monitor(episode_ids=episode_ids, monitored=True)
-    # Update series with monitoring enabled and search for episodes
-
-    # Search for all monitored episodes
-    whisparr.post_command(name="SeriesSearch", seriesId=studio_id)
-    return updated
-
-
-def add_studio_to_whisparr(studio_name: str):
+# Whisparr studio onboarding: requests in flight and a token bucket of
+# WHISPARR_RATE requests per second with bursts of WHISPARR_BURST
+WHISPARR_CONCURRENCY = int(os.environ.get("WHISPARR_CONCURRENCY", 4))
+WHISPARR_RATE = float(os.environ.get("WHISPARR_RATE", 5))
+WHISPARR_BURST = int(os.environ.get("WHISPARR_BURST", 10))
+WHISPARR_RETRY_STATUSES = (429, 502, 503, 504)
+# Seconds to wait for the episode lists of newly added series before searching
+WHISPARR_REFRESH_TIMEOUT = float(os.environ.get("WHISPARR_REFRESH_TIMEOUT", 600))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncWhisparr:
+    """Minimal async Whisparr v3 API client sharing one concurrency limit and rate limiter"""
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: str,
+        concurrency: int = WHISPARR_CONCURRENCY,
+        rate: float = WHISPARR_RATE,
+        burst: int = WHISPARR_BURST,
+        retries: int = 5,
+    ):
+        self.base_url = base_url.rstrip("/") + "/api/v3/"
+        self.api_key = api_key
+        self.retries = retries
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate, burst)
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            headers={"X-Api-Key": self.api_key, "Content-Type": "application/json"},
+            timeout=aiohttp.ClientTimeout(total=120),
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def request(self, method: str, path: str, **kwargs):
+        for attempt in range(self.retries):
+            try:
+                async with self.semaphore:
+                    await self.bucket.acquire()
+                    async with self.session.request(
+                        method, self.base_url + path, ssl=False, **kwargs
+                    ) as response:
+                        if response.status not in WHISPARR_RETRY_STATUSES:
+                            response.raise_for_status()
+                            text = await response.text()
+                            return json.loads(text) if text else None
+                        error = aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status
+                        )
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt == self.retries - 1:
+                raise error
+            await asyncio.sleep(2**attempt)
+
+
+async def add_studio_to_whisparr(client: AsyncWhisparr, studio_name: str):
+    """Add or update a studio's series so it and all its episodes are monitored.
+
+    Returns:
+        int: the series id, None if the series was already fully monitored
+    """
     # Search for studio using series lookup endpoint
-    results = whisparr.lookup_series(term=studio_name)
-    # print(f'{results=}')
-    results = [r for r in results if isinstance(r, dict)]
+    results = await client.request("GET", "series/lookup", params={"term": studio_name})
+    results = [r for r in results or [] if isinstance(r, dict)]
     if not results:
         raise ValueError(f"No results found for studio: {studio_name}")
 
     # Get best match
     data = results[0]
-    # data = min(results, key=lambda x: len(set(x['title'].lower()) ^ set(studio_name.lower())))
-    # print(f'[d] Found {len(results)} results while searching for "{studio_name}": {[x["title"] for x in results]}\nUsing: {data["title"]}')
-
-    # Update required fields
-    data["qualityProfileId"] = 1
-    data["addOptions"] = {
-        "monitor": "all",
-        "searchForMissingEpisodes": True,
-        "searchForCutoffUnmetEpisodes": False,
-    }
-    data["rootFolderPath"] = "/data/media/whisparr"
 
     # first check if studio is already added
     if "id" not in data:
-        # Add studio using series endpoint
-        data = whisparr.add_series(
-            series=data,
-            quality_profile_id=1,
-            language_profile_id=1,  # Using default language profile ID
-            root_dir="/data/media/whisparr",
-            search_for_missing_episodes=True,
+        # searching is left to the aggregated search at the end of the run
+        data.update(
+            qualityProfileId=1,
+            languageProfileId=1,
+            rootFolderPath="/data/media/whisparr",
+            monitored=True,
+            monitorNewItems="all",
+            addOptions={
+                "monitor": "all",
+                "searchForMissingEpisodes": False,
+                "searchForCutoffUnmetEpisodes": False,
+            },
         )
-        logger.debug(f"Studio {studio_name} not found on Whisparr, added", end=" ")
-    else:
-        logger.info(f'Studio "{studio_name}" already added to Whisparr', end=" ")
-    logger.info(WHISPARR_BASE_URL + "/site/" + data["sortTitle"].replace(" ", ""))
-
-    # # Update monitoring options
-    update_data = update_studio_on_whisparr(data["id"])
-    return data, update_data
-
-
-# studio_name = 'Futabasha'
-# studio_data, update_data = add_studio_to_whisparr(studio_name)
-
-
-def add_studio_wrapper(studio):
-    try:
-        studio_data, update_data = add_studio_to_whisparr(studio["name"])
-        return studio_data, update_data
-    except Exception as e:
-        logger.error(f"Error adding studio {studio['name']}: {e}")
-        return None, None
+        series = await client.request("POST", "series", json=data)
+        logger.debug(f"Studio {studio_name} not found on Whisparr, added")
+        return series["id"]
+
+    series = await client.request("GET", f"series/{data['id']}")
+    statistics = series.get("statistics") or {}
+    if (
+        series.get("monitored")
+        and series.get("monitorNewItems") == "all"
+        and all(season.get("monitored") for season in series.get("seasons", []))
+        and statistics.get("episodeCount") == statistics.get("totalEpisodeCount")
+    ):
+        logger.info(f'Studio "{studio_name}" already monitored on Whisparr')
+        return None
+
+    logger.info(f'Studio "{studio_name}" already added to Whisparr, monitoring it')
+    series["monitored"] = True
+    series["monitorNewItems"] = "all"
+    for season in series.get("seasons", []):
+        season["monitored"] = True
+    await client.request("PUT", f"series/{series['id']}", json=series)
+    # monitors every episode server side, without listing the episodes
+    await client.request(
+        "POST",
+        "seasonpass",
+        json={
+            "series": [{"id": series["id"], "monitored": True}],
+            "monitoringOptions": {"monitor": "all"},
+        },
+    )
+    return series["id"]
+
+
+async def wait_for_series_refresh(client: AsyncWhisparr, series_ids, timeout: float):
+    """Wait until Whisparr refreshed ``series_ids``, a new series has no episodes before"""
+    series_ids = set(series_ids)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = False
+        for command in await client.request("GET", "command") or []:
+            body = command.get("body") or {}
+            refreshed = set(body.get("seriesIds") or [body.get("seriesId")])
+            if (
+                command.get("name") == "RefreshSeries"
+                and command.get("status") in ("queued", "started")
+                and refreshed & series_ids
+            ):
+                busy = True
+                break
+        if not busy:
+            return
+        await asyncio.sleep(5)
+    logger.warning(f"Series still refreshing after {timeout}s, searching what is known")
+
+
+async def missing_episode_ids(client: AsyncWhisparr, series_id: int) -> list:
+    episodes = await client.request("GET", "episode", params={"seriesId": series_id})
+    return [
+        episode["id"]
+        for episode in episodes or []
+        if episode.get("monitored") and not episode.get("hasFile")
+    ]
 
 
-with ThreadPool() as pool:
-    results = list(
-        tqdm(
-            pool.imap(add_studio_wrapper, stashdb_favorite_studios),
-            total=len(stashdb_favorite_studios),
-            desc="Adding studios from stashdb to Whisparr",
-        )
-    )
+async def add_studios_to_whisparr(studios) -> list:
+    """Onboard studios as they stream in, then search the missing episodes of the touched series"""
+    touched = []
+    pbar = tqdm(desc="Adding studios from stashdb to Whisparr")
+    async with AsyncWhisparr(WHISPARR_BASE_URL, WHISPARR_API_KEY) as client:
+
+        async def add(studio):
+            try:
+                series_id = await add_studio_to_whisparr(client, studio["name"])
+                if series_id is not None:
+                    touched.append(series_id)
+            except Exception as e:
+                logger.error(f"Error adding studio {studio['name']}: {e}")
+                sync_failures["studios"].add(studio["id"])
+            pbar.update(1)
+
+        tasks = []
+        studios = iter(studios)
+        while True:
+            # the stream blocks on StashDB pages, pull it off the event loop
+            studio = await asyncio.to_thread(next, studios, None)
+            if studio is None:
+                break
+            tasks.append(asyncio.create_task(add(studio)))
+        await asyncio.gather(*tasks)
+        pbar.close()
+
+        # one EpisodeSearch over the missing episodes of the touched series, instead
+        # of a search per series or a MissingEpisodeSearch of the whole library
+        if touched:
+            try:
+                await wait_for_series_refresh(client, touched, WHISPARR_REFRESH_TIMEOUT)
+                missing = await asyncio.gather(
+                    *(missing_episode_ids(client, id) for id in touched)
+                )
+                episode_ids = [id for ids in missing for id in ids]
+                if episode_ids:
+                    await client.request(
+                        "POST",
+                        "command",
+                        json={"name": "EpisodeSearch", "episodeIds": episode_ids},
+                    )
+                logger.info(
+                    f"Started a search for {len(episode_ids)} missing episodes "
+                    f"of {len(touched)} studios"
+                )
+            except Exception as e:
+                logger.error(
+                    f"Failed to search the missing episodes of {len(touched)} studios: {e}"
+                )
+    return touched
+
+
+whisparr_touched_series = asyncio.run(add_studios_to_whisparr(stashdb_studios_to_sync))
 
 # %%
 
@@ -442,6 +637,26 @@ stash = StashInterface(
 
 
 # %%
+## Index StashApp performers and studios by StashDB ID
+#
+# A few paged queries fetch every performer and studio with their stash_ids,
+# matching StashDB favorites is then a dictionary lookup and favorites are
+# updated in batches.
+
+STASHAPP_PER_PAGE = int(os.environ.get("STASHAPP_PER_PAGE", 1000))
+# Entities whose favorite flag is updated per request
+STASHAPP_UPDATE_CHUNK = int(os.environ.get("STASHAPP_UPDATE_CHUNK", 100))
+
+stashapp_index_queries = {
+    "performers": (
+        "findPerformers",
+        "query FindPerformers($filter: FindFilterType) {\n  findPerformers(filter: $filter) {\n    count\n    performers {\n      id\n      name\n      disambiguation\n      alias_list\n      favorite\n      stash_ids {\n        stash_id\n        endpoint\n      }\n    }\n  }\n}",
+    ),
+    "studios": (
+        "findStudios",
+        "query FindStudios($filter: FindFilterType) {\n  findStudios(filter: $filter) {\n    count\n    studios {\n      id\n      name\n      aliases\n      favorite\n      stash_ids {\n        stash_id\n        endpoint\n      }\n    }\n  }\n}",
+    ),
+}
 
 
 @backoff.on_exception(
@@ -450,217 +665,155 @@ stash = StashInterface(
     max_tries=5,
     jitter=None,
 )
-@loggo
-@memory.cache(ignore=[])
-def stashdb_id_to_stashapp_performer(id: int):
-    json_data = {
-        "operationName": "FindPerformers",
-        "variables": {
-            "filter": {
-                "q": "",
-                "page": 1,
-                "per_page": 40,
-            },
-            "performer_filter": {
-                "stash_id_endpoint": {
-                    "endpoint": "",
-                    "stash_id": id,
-                    "modifier": "EQUALS",
-                },
-            },
-        },
-        "query": "query FindPerformers($filter: FindFilterType, $performer_filter: PerformerFilterType, $performer_ids: [Int!]) {\n  findPerformers(\n    filter: $filter\n    performer_filter: $performer_filter\n    performer_ids: $performer_ids\n  ) {\n    count\n    performers {\n      ...PerformerData\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment PerformerData on Performer {\n  id\n  name\n  disambiguation\n  urls\n  gender\n  birthdate\n  ethnicity\n  country\n  eye_color\n  height_cm\n  measurements\n  fake_tits\n  penis_length\n  circumcised\n  career_length\n  tattoos\n  piercings\n  alias_list\n  favorite\n  ignore_auto_tag\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  group_count\n  performer_count\n  o_counter\n  tags {\n    ...SlimTagData\n    __typename\n  }\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  rating100\n  details\n  death_date\n  hair_color\n  weight\n  __typename\n}\n\nfragment SlimTagData on Tag {\n  id\n  name\n  aliases\n  image_path\n  parent_count\n  child_count\n  __typename\n}",
-    }
-
+def stashapp_graphql(query: str, variables: dict = None) -> dict:
     response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
+        f"{STASH_BASE_URL}/graphql",
+        headers=stash_headers,
+        json={"query": query, "variables": variables or {}},
+        verify=False,
     )
     response.raise_for_status()
     data = response.json()
-    return data["data"]["findPerformers"]["performers"]
+    if data.get("errors"):
+        raise requests.exceptions.RequestException(f"StashApp: {data['errors']}")
+    return data["data"]
 
 
-def stashapp_search_performers(name: str):
-    json_data = {
-        "operationName": "FindPerformers",
-        "variables": {"filter": {"q": name, "page": 1, "per_page": 40}},
-        "query": "query FindPerformers($filter: FindFilterType, $performer_filter: PerformerFilterType, $performer_ids: [Int!]) {\n  findPerformers(\n    filter: $filter\n    performer_filter: $performer_filter\n    performer_ids: $performer_ids\n  ) {\n    count\n    performers {\n      ...PerformerData\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment PerformerData on Performer {\n  id\n  name\n  disambiguation\n  urls\n  gender\n  birthdate\n  ethnicity\n  country\n  eye_color\n  height_cm\n  measurements\n  fake_tits\n  penis_length\n  circumcised\n  career_length\n  tattoos\n  piercings\n  alias_list\n  favorite\n  ignore_auto_tag\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  group_count\n  performer_count\n  o_counter\n  tags {\n    ...SlimTagData\n    __typename\n  }\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  rating100\n  details\n  death_date\n  hair_color\n  weight\n  __typename\n}\n\nfragment SlimTagData on Tag {\n  id\n  name\n  aliases\n  image_path\n  parent_count\n  child_count\n  __typename\n}",
-    }
-
-    response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["data"]["findPerformers"]["performers"]
+def fetch_stashapp_all(kind: str) -> list:
+    """Every StashApp performer or studio, one page of STASHAPP_PER_PAGE at a time"""
+    field, query = stashapp_index_queries[kind]
+    entities, page = [], 1
+    while True:
+        data = stashapp_graphql(
+            query,
+            {
+                "filter": {
+                    "page": page,
+                    "per_page": STASHAPP_PER_PAGE,
+                    "sort": "id",
+                    "direction": "ASC",
+                }
+            },
+        )[field]
+        entities.extend(data[kind])
+        if not data[kind] or len(entities) >= data["count"]:
+            return entities
+        page += 1
 
 
-for stashdb_performer in tqdm(
-    stashdb_favorite_performers, desc="Adding performers from stashdb to StashApp"
-):
-    stashapp_performers = stashdb_id_to_stashapp_performer(stashdb_performer["id"])
-    stashdb_url = f"https://stashdb.org/performers/{stashdb_performer['id']}"
-    performer_name = stashdb_performer["name"]
-    if not stashapp_performers:
-        logger.warning(
-            f'Performer not found on StashApp, retrying with name search "{performer_name}"',
-            end=" ... ",
+def stashapp_match(kind: str, stashdb_entity: dict):
+    """StashApp entity of a StashDB favorite: by linked stash ID, else by name"""
+    index = stashapp_indexes[kind]
+    linked = index.find(stashdb_entity["id"])
+    if linked:
+        return linked[0]
+    stashdb_url = f"https://stashdb.org/{kind}/{stashdb_entity['id']}"
+    entity, confidence, how = index.match(
+        stashdb_entity["name"],
+        stashdb_entity.get("aliases") or [],
+        stashdb_entity.get("disambiguation"),
+    )
+    if entity is None or confidence < SYNC_MATCH_MIN_CONFIDENCE:
+        logger.error(
+            f'No confident StashApp match for "{stashdb_entity["name"]}" ({stashdb_url}): '
+            f"{how}, confidence {confidence:.2f}"
         )
-        stashapp_performers = stashapp_search_performers(performer_name)
-        if not stashapp_performers:
-            logger.error(
-                f'name search failed, skipping "{performer_name}" ({stashdb_url})'
+        return None
+    logger.info(
+        f'Matched "{stashdb_entity["name"]}" ({stashdb_url}) to StashApp "{entity["name"]}" '
+        f"{STASH_BASE_URL}/{kind}/{entity['id']} by {how}, confidence {confidence:.2f}"
+    )
+    return entity
+
+
+def stashapp_set_favorites(kind: str, ids, favorite: bool = True):
+    """Set the favorite flag of StashApp performers or studios in batches"""
+    ids = list(dict.fromkeys(ids))
+    for i in range(0, len(ids), STASHAPP_UPDATE_CHUNK):
+        chunk = ids[i : i + STASHAPP_UPDATE_CHUNK]
+        if kind == "performers":
+            stashapp_graphql(
+                "mutation BulkPerformerUpdate($input: BulkPerformerUpdateInput!) {\n  bulkPerformerUpdate(input: $input) {\n    id\n  }\n}",
+                {"input": {"ids": chunk, "favorite": favorite}},
             )
-            continue
         else:
-            stashapp_url = f"{STASH_BASE_URL}/performers/{stashapp_performers[0]['id']}"
-            logger.info(
-                f'Found {len(stashapp_performers)} performers on StashApp for "{performer_name}" ({stashdb_url}) -> {stashapp_url}'
+            # no bulk studio update, send aliased studioUpdate mutations in one request
+            params = ", ".join(f"$s{n}: StudioUpdateInput!" for n in range(len(chunk)))
+            fields = "\n".join(
+                f"  s{n}: studioUpdate(input: $s{n}) {{\n    id\n  }}"
+                for n in range(len(chunk))
             )
+            stashapp_graphql(
+                f"mutation StudiosUpdate({params}) {{\n{fields}\n}}",
+                {f"s{n}": {"id": id, "favorite": favorite} for n, id in enumerate(chunk)},
+            )
+        logger.info(f"Set favorite={favorite} on {len(chunk)} StashApp {kind}")
 
-    stashapp_url = f"{STASH_BASE_URL}/performers/{stashapp_performers[0]['id']}"
-    stashapp_performer = stashapp_performers[0]
-
-    if stashapp_performer["favorite"]:
-        # print(f"[i] Performer already favorite on StashApp "{performer_name}" ({stashdb_url}) {stashapp_url}")
-        continue
 
-    ## set as favorite
-    json_data = {
-        "operationName": "PerformerUpdate",
-        "variables": {
-            "input": {
-                "id": stashapp_performer["id"],
-                "favorite": True,
-            },
-        },
-        "query": "mutation PerformerUpdate($input: PerformerUpdateInput!) {\n  performerUpdate(input: $input) {\n    ...PerformerData\n    __typename\n  }\n}\n\nfragment PerformerData on Performer {\n  id\n  name\n  disambiguation\n  urls\n  gender\n  birthdate\n  ethnicity\n  country\n  eye_color\n  height_cm\n  measurements\n  fake_tits\n  penis_length\n  circumcised\n  career_length\n  tattoos\n  piercings\n  alias_list\n  favorite\n  ignore_auto_tag\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  group_count\n  performer_count\n  o_counter\n  tags {\n    ...SlimTagData\n    __typename\n  }\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  rating100\n  details\n  death_date\n  hair_color\n  weight\n  __typename\n}\n\nfragment SlimTagData on Tag {\n  id\n  name\n  aliases\n  image_path\n  parent_count\n  child_count\n  __typename\n}",
-    }
-
-    logger.info(
-        f'Setting "{performer_name}" ({stashdb_url}) as favorite on StashApp {stashapp_url}'
-    )
-    response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    logger.debug(response.json())
+stashapp_indexes = {
+    "performers": StashAppIndex("performers", fetch_stashapp_all("performers")),
+    "studios": StashAppIndex("studios", fetch_stashapp_all("studios")),
+}
 
 
 # %%
 
 
-@backoff.on_exception(
-    backoff.expo,
-    (requests.exceptions.RequestException, requests.exceptions.HTTPError),
-    max_tries=5,
-    jitter=None,
-)
-@loggo
-@memory.cache(ignore=[])
-def stashdb_id_to_stashapp_studio(id: int):
-    json_data = {
-        "operationName": "FindStudios",
-        "variables": {
-            "filter": {
-                "q": "",
-                "page": 1,
-                "per_page": 40,
-            },
-            "studio_filter": {
-                "stash_id_endpoint": {
-                    "endpoint": "",
-                    "stash_id": id,
-                    "modifier": "EQUALS",
-                },
-            },
-        },
-        "query": "query FindStudios($filter: FindFilterType, $studio_filter: StudioFilterType) {\n  findStudios(filter: $filter, studio_filter: $studio_filter) {\n    count\n    studios {\n      ...StudioData\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment StudioData on Studio {\n  id\n  name\n  url\n  parent_studio {\n    id\n    name\n    url\n    __typename\n  }\n  child_studios {\n    id\n    name\n    __typename\n  }\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  performer_count\n  details\n  rating100\n  favorite\n  aliases\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  __typename\n}",
-    }
+def stashapp_favorites_to_set(kind: str, stashdb_entities) -> list:
+    """IDs of the StashApp entities of ``stashdb_entities`` that aren't favorite yet.
 
-    response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["data"]["findStudios"]["studios"]
+    Favorites without a StashApp entity are recorded in ``stashapp_unmatched``:
+    they are snapshotted like the others and only their StashApp match is
+    retried on the next runs.
+    """
+    to_favorite = []
+    for stashdb_entity in stashdb_entities:
+        stashapp_entity = stashapp_match(kind, stashdb_entity)
+        if stashapp_entity is None:
+            # not in StashApp yet (e.g. no scene identified so far)
+            stashapp_unmatched[kind].add(stashdb_entity["id"])
+            continue
+        stashdb_url = f"https://stashdb.org/{kind}/{stashdb_entity['id']}"
+        name = stashdb_entity["name"]
+        stashapp_url = f"{STASH_BASE_URL}/{kind}/{stashapp_entity['id']}"
 
+        if stashapp_entity["favorite"]:
+            logger.debug(
+                f'Already favorite on StashApp "{name}" ({stashdb_url}) {stashapp_url}'
+            )
+            continue
 
-@backoff.on_exception(
-    backoff.expo,
-    (requests.exceptions.RequestException, requests.exceptions.HTTPError),
-    max_tries=5,
-    jitter=None,
-)
-@loggo
-@memory.cache(ignore=[])
-def stashapp_search_studios(name: str):
-    json_data = {
-        "operationName": "FindStudios",
-        "variables": {"filter": {"q": name, "page": 1, "per_page": 40}},
-        "query": "query FindStudios($filter: FindFilterType, $studio_filter: StudioFilterType) {\n  findStudios(filter: $filter, studio_filter: $studio_filter) {\n    count\n    studios {\n      ...StudioData\n      __typename\n    }\n    __typename\n  }\n}\n\nfragment StudioData on Studio {\n  id\n  name\n  url\n  parent_studio {\n    id\n    name\n    url\n    __typename\n  }\n  child_studios {\n    id\n    name\n    __typename\n  }\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  performer_count\n  details\n  rating100\n  favorite\n  aliases\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  __typename\n}",
-    }
+        logger.info(
+            f'Setting "{name}" ({stashdb_url}) as favorite on StashApp {stashapp_url}'
+        )
+        to_favorite.append(stashapp_entity["id"])
+    return to_favorite
 
-    response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    data = response.json()
-    return data["data"]["findStudios"]["studios"]
 
+stashapp_unmatched = {"studios": set(), "performers": set()}
 
-for stashdb_studio in tqdm(
-    stashdb_favorite_studios, desc="Adding studios from stashdb to StashApp"
-):
-    stashapp_studios = stashdb_id_to_stashapp_studio(stashdb_studio["id"])
-    stashdb_url = f"https://stashdb.org/studios/{stashdb_studio['id']}"
-    studio_name = stashdb_studio["name"]
-    if not stashapp_studios:
-        logger.warning(
-            f'Studio not found on StashApp, retrying with name search "{studio_name}"',
-            end=" ... ",
-        )
-        stashapp_studios = stashapp_search_studios(studio_name)
-        if not stashapp_studios:
-            logger.error(
-                f'name search failed, skipping "{studio_name}" ({stashdb_url})'
-            )
-            continue
-        else:
-            stashapp_url = f"{STASH_BASE_URL}/studios/{stashapp_studios[0]['id']}"
-            logger.info(
-                f'Found {len(stashapp_studios)} studios on StashApp for "{studio_name}" ({stashdb_url}) -> {stashapp_url}'
-            )
+stashapp_performers_to_favorite = stashapp_favorites_to_set(
+    "performers",
+    tqdm(stashdb_performers_to_sync, desc="Adding performers from stashdb to StashApp"),
+)
+# the stream is consumed, unchanged favorites not matched on earlier runs are known now
+stashapp_performers_to_favorite += stashapp_favorites_to_set(
+    "performers", performers_diff.stashapp_pending
+)
+stashapp_set_favorites("performers", stashapp_performers_to_favorite)
 
-    stashapp_url = f"{STASH_BASE_URL}/studios/{stashapp_studios[0]['id']}"
-    stashapp_studio = stashapp_studios[0]
 
-    if stashapp_studio["favorite"]:
-        logger.info(
-            f'Studio already favorite on StashApp "{studio_name}" ({stashdb_url}) {stashapp_url}'
-        )
-        continue
+# %%
 
-    ## set as favorite
-    json_data = {
-        "operationName": "StudioUpdate",
-        "variables": {
-            "input": {
-                "id": stashapp_studio["id"],
-                "favorite": True,
-            },
-        },
-        "query": "mutation StudioUpdate($input: StudioUpdateInput!) {\n  studioUpdate(input: $input) {\n    ...StudioData\n    __typename\n  }\n}\n\nfragment StudioData on Studio {\n  id\n  name\n  url\n  parent_studio {\n    id\n    name\n    url\n    __typename\n  }\n  child_studios {\n    id\n    name\n    __typename\n  }\n  image_path\n  scene_count\n  image_count\n  gallery_count\n  performer_count\n  details\n  rating100\n  favorite\n  aliases\n  stash_ids {\n    stash_id\n    endpoint\n    __typename\n  }\n  __typename\n}",
-    }
 
-    logger.info(
-        f'Setting "{studio_name}" ({stashdb_url}) as favorite on StashApp {stashapp_url}'
-    )
-    response = requests.post(
-        f"{STASH_BASE_URL}/graphql", headers=stash_headers, json=json_data, verify=False
-    )
-    response.raise_for_status()
-    logger.debug(response.json())
+stashapp_studios_to_favorite = stashapp_favorites_to_set(
+    "studios",
+    tqdm(
+        studios_diff.to_sync + studios_diff.stashapp_pending,
+        desc="Adding studios from stashdb to StashApp",
+    ),
+)
+stashapp_set_favorites("studios", stashapp_studios_to_favorite)
 
 
 # %%
@@ -709,17 +862,25 @@ def get_tpdb_performer_data(id: str):
     return tpdb_performer_data
 
 
+stashdb_to_tpdb = {}  # stashdb performer id -> (tpdb id, tpdb slug)
+
 tpdb_performer_datas = list(
     tqdm(
         ThreadPool(10).imap(
-            get_tpdb_performer_data, [x["id"] for x in stashdb_favorite_performers]
+            get_tpdb_performer_data, [x["id"] for x in performers_diff.to_sync]
         ),
-        total=len(stashdb_favorite_performers),
+        total=len(performers_diff.to_sync),
         desc="Getting TPDB performer data",
     )
 )
-for tpdb_performer_data in tpdb_performer_datas:
+for stashdb_performer, tpdb_performer_data in zip(
+    performers_diff.to_sync, tpdb_performer_datas
+):
     tpdb_ids[tpdb_performer_data["id"]] = tpdb_performer_data["slug"]
+    stashdb_to_tpdb[stashdb_performer["id"]] = (
+        tpdb_performer_data["id"],
+        tpdb_performer_data["slug"],
+    )
 
 
 # %%
@@ -777,7 +938,19 @@ def get_importlists():
 
 params = ""
 
+# changed favorites come through here again, their import list already exists
+existing_importlist_performers = {
+    field.get("value")
+    for importlist in get_importlists()
+    if importlist.get("implementation") == "TPDbPerformer"
+    for field in importlist.get("fields", [])
+    if field["name"] == "performerId"
+}
+
 for id, name in tqdm(tpdb_ids.items(), desc="Adding performers to Whisparr"):
+    if str(id) in existing_importlist_performers:
+        logger.info(f"Whisparr import list for performer {name} (ID: {id}) already exists")
+        continue
     tags = [create_tag("performer--" + name), create_tag("performer")]
     json_data = {
         "enableAutomaticAdd": False,
@@ -811,10 +984,131 @@ for id, name in tqdm(tpdb_ids.items(), desc="Adding performers to Whisparr"):
         json=json_data,
         verify=False,
     )
-    # response.raise_for_status()
+    if not response.ok:
+        logger.error(
+            f"Failed to add Whisparr import list for performer {name} (ID: {id}): "
+            f"{response.status_code} {response.text}"
+        )
+        sync_failures["performers"].update(
+            stashdb_id
+            for stashdb_id, (tpdb_id, _) in stashdb_to_tpdb.items()
+            if tpdb_id == id
+        )
+        continue
     print(response.json())
 
 
+# %%
+## Undo the downstream actions for favorites dropped on StashDB
+
+
+def remove_performer_importlist(tpdb_id: str):
+    for importlist in get_importlists():
+        fields = {x["name"]: x.get("value") for x in importlist.get("fields", [])}
+        if importlist.get("implementation") == "TPDbPerformer" and fields.get(
+            "performerId"
+        ) == str(tpdb_id):
+            response = requests.delete(
+                f"{WHISPARR_BASE_URL}/api/v3/importlist/{importlist['id']}",
+                headers=whisparr_headers,
+                verify=False,
+            )
+            response.raise_for_status()
+            logger.info(f"Removed Whisparr import list {importlist['name']}")
+
+
+def unfavorite_tpdb_performer(tpdb_id: str):
+    while True:
+        # toggle
+        response = requests.post(
+            "https://api.theporndb.net/favourites",
+            headers=tpdb_headers,
+            json={"type": "performer", "value": tpdb_id},
+        )
+        response.raise_for_status()
+        if response.json()["value"] is False:
+            break
+
+
+def unmonitor_studio_on_whisparr(studio_name: str):
+    results = [r for r in whisparr.lookup_series(term=studio_name) if isinstance(r, dict)]
+    if not results or "id" not in results[0]:
+        return
+    series = whisparr.get_series(results[0]["id"])
+    series["monitored"] = False
+    series["monitorNewItems"] = "none"
+    whisparr.upd_series(data=series)
+
+
+for diff, kind in ((studios_diff, "studios"), (performers_diff, "performers")):
+    logger.info(diff.summary(kind))
+
+for kind, diff in (("performers", performers_diff), ("studios", studios_diff)):
+    try:
+        stashapp_set_favorites(
+            kind,
+            [
+                entity["id"]
+                for removed in diff.removed
+                for entity in stashapp_indexes[kind].find(removed["id"])
+                if entity["favorite"]
+            ],
+            favorite=False,
+        )
+    except Exception as e:
+        logger.error(f"Error unfavoriting dropped {kind} on StashApp: {e}")
+        sync_failures[kind].update(removed["id"] for removed in diff.removed)
+
+for removed in tqdm(performers_diff.removed, desc="Removing dropped performers"):
+    try:
+        logger.info(f'Performer "{removed["name"]}" is no longer a StashDB favorite')
+        if removed.get("tpdb_id"):
+            unfavorite_tpdb_performer(removed["tpdb_id"])
+            remove_performer_importlist(removed["tpdb_id"])
+    except Exception as e:
+        logger.error(f'Error removing performer "{removed["name"]}": {e}')
+        sync_failures["performers"].add(removed["id"])
+
+for removed in tqdm(studios_diff.removed, desc="Removing dropped studios"):
+    try:
+        logger.info(f'Studio "{removed["name"]}" is no longer a StashDB favorite')
+        unmonitor_studio_on_whisparr(removed["name"])
+    except Exception as e:
+        logger.error(f'Error removing studio "{removed["name"]}": {e}')
+        sync_failures["studios"].add(removed["id"])
+
+
+# %%
+## Save the snapshot of what was synced
+
+next_snapshot = {"studios": {}, "performers": {}}
+for kind, favorites in (
+    ("studios", studios_diff.current),
+    ("performers", performers_diff.current),
+):
+    previous = sync_snapshot[kind]
+    for entity in favorites:
+        if entity["id"] in sync_failures[kind]:
+            if entity["id"] in previous:
+                next_snapshot[kind][entity["id"]] = previous[entity["id"]]
+            continue
+        entry = {"hash": content_hash(entity), "name": entity["name"]}
+        if entity["id"] in stashapp_unmatched[kind]:
+            entry["stashapp"] = False
+        if kind == "performers":
+            old = previous.get(entity["id"], {})
+            tpdb_id, tpdb_slug = stashdb_to_tpdb.get(
+                entity["id"], (old.get("tpdb_id"), old.get("tpdb_slug"))
+            )
+            entry.update(tpdb_id=tpdb_id, tpdb_slug=tpdb_slug)
+        next_snapshot[kind][entity["id"]] = entry
+    # removals that failed are kept so they are retried
+    for id in sync_failures[kind]:
+        if id in previous and id not in next_snapshot[kind]:
+            next_snapshot[kind][id] = previous[id]
+save_sync_snapshot(next_snapshot)
+
+
 # %%
 # %pip install joblib loguru backoff warpt
 
@@ -0,0 +1,95 @@
+import pytest
+
+from sync_favorites import StashAppIndex, normalize_name, trigrams
+
+STASHDB = "https://stashdb.org/graphql"
+
+
+def performer(id, name, aliases=(), disambiguation=None, stash_ids=()):
+    return {
+        "id": id,
+        "name": name,
+        "alias_list": list(aliases),
+        "disambiguation": disambiguation,
+        "favorite": False,
+        "stash_ids": [{"stash_id": s, "endpoint": STASHDB} for s in stash_ids],
+    }
+
+
+def index(*entities):
+    """A StashAppIndex over the performers passed in, no StashApp involved."""
+    return StashAppIndex("performers", list(entities))
+
+
+def test_normalize_name():
+    assert normalize_name("  Zoë  O'Neil ") == "zoe o neil"
+    assert normalize_name(None) == ""
+
+
+def test_linked_entities_are_found_by_stash_id_only():
+    idx = index(performer("1", "Jane Doe", stash_ids=["abc"]))
+
+    assert idx.find("abc")[0]["id"] == "1"
+    assert idx.match("Jane Doe")[0] is None
+
+
+def test_exact_name_then_alias():
+    idx = index(performer("1", "Jane Doe"), performer("2", "Janet", aliases=["JD"]))
+
+    assert idx.match("jane doe") == (idx.entities[0], 1.0, "name")
+    entity, confidence, how = idx.match("Someone", aliases=["jd"])
+    assert (entity["id"], how) == ("2", "alias")
+
+
+def test_same_name_is_ambiguous_without_disambiguation():
+    idx = index(performer("1", "Anna", disambiguation="I"), performer("2", "Anna", disambiguation="II"))
+
+    entity, confidence, reason = idx.match("Anna")
+    assert entity is None and reason == "2 name matches"
+    assert idx.match("Anna", disambiguation="II")[0]["id"] == "2"
+
+
+def test_contradicting_disambiguation_rejects_a_single_exact_hit():
+    idx = index(performer("1", "Anna", disambiguation="Czech"))
+
+    assert idx.match("Anna", disambiguation="czech")[0]["id"] == "1"
+    assert idx.match("Anna", disambiguation="Russian")[0] is None
+    # nothing to contradict when StashApp has no disambiguation
+    assert index(performer("1", "Anna")).match("Anna", disambiguation="Russian")[0]["id"] == "1"
+
+
+def test_trigram_match_and_ambiguity():
+    idx = index(
+        performer("1", "Alexandra Catherine Smithson"), performer("2", "Completely Different")
+    )
+
+    entity, confidence, how = idx.match("Alexandra Catherine Smithsonn")
+    assert (entity["id"], how) == ("1", "trigram")
+    assert confidence == pytest.approx(28 / 31)
+
+    twins = index(
+        performer("1", "Alexandra Catherine Smithsonn"),
+        performer("2", "Alexandra Catherine Smithsonm"),
+    )
+    entity, confidence, reason = twins.match("Alexandra Catherine Smithson")
+    assert entity is None and reason.startswith("ambiguous")
+
+
+def test_no_candidates():
+    assert index(performer("1", "Jane Doe")).match("Xyzzy Quux") == (None, 0.0, "no candidates")
+
+
+def test_prefix_filter_keeps_every_candidate_above_threshold():
+    names = [f"performer {a}{b}" for a in "abcdefgh" for b in "abcdefgh"]
+    idx = index(*(performer(str(i), name) for i, name in enumerate(names)))
+    query = "performer cdx"
+    threshold = 0.5
+    query_trigrams = trigrams(query)
+
+    def jaccard(other):
+        return len(query_trigrams & other) / len(query_trigrams | other)
+
+    expected = {name for name, other in idx.trigram_sets.items() if jaccard(other) >= threshold}
+
+    assert set(idx._similar(query, threshold)) == expected
+    assert expected
@@ -0,0 +1,104 @@
+import pytest
+
+import sync_favorites
+from sync_favorites import FavoritesDiff, content_hash, load_sync_snapshot, save_sync_snapshot
+
+
+@pytest.fixture(autouse=True)
+def snapshot_file(tmp_path, monkeypatch):
+    path = tmp_path / "sync_snapshot.json"
+    monkeypatch.setattr(sync_favorites, "SYNC_SNAPSHOT_FILE", str(path))
+    monkeypatch.setattr(sync_favorites, "SYNC_FULL", False)
+    return path
+
+
+def performer(id, name, **fields):
+    return {
+        "id": id,
+        "name": name,
+        "disambiguation": None,
+        "aliases": [],
+        "urls": [{"url": f"https://example.com/{id}", "site": {"name": "Example"}}],
+        "images": [],
+        **fields,
+    }
+
+
+def entry(entity):
+    return {"hash": content_hash(entity), "name": entity["name"]}
+
+
+def test_content_hash_only_covers_synced_fields():
+    base = performer("1", "Jane", aliases=["J", "Janie"])
+
+    assert content_hash(base) == content_hash(dict(base, images=[{"url": "x"}], updated="now"))
+    assert content_hash(base) == content_hash(dict(base, aliases=["Janie", "J"]))
+    assert content_hash(base) != content_hash(dict(base, name="Jane Doe"))
+    assert content_hash(base) != content_hash(dict(base, urls=[]))
+
+
+def test_diff_classifies_favorites():
+    unchanged = performer("1", "Same")
+    changed = performer("2", "Renamed")
+    added = performer("3", "New")
+    previous = {
+        "1": entry(unchanged),
+        "2": entry(performer("2", "Old name")),
+        "4": {"hash": "x", "name": "Gone"},
+    }
+    diff = FavoritesDiff(previous)
+
+    streamed = list(diff.feed(iter([unchanged, changed, added])))
+
+    assert [x["id"] for x in streamed] == ["2", "3"]
+    assert [x["id"] for x in diff.to_sync] == ["3", "2"]
+    assert diff.removed == [{"hash": "x", "name": "Gone", "id": "4"}]
+    assert diff.summary("performers") == (
+        "Favorite performers: 1 added, 1 changed, 1 removed, 1 unchanged"
+    )
+
+
+def test_diff_streams_lazily():
+    seen = []
+
+    def favorites():
+        for entity in [performer("1", "A"), performer("2", "B")]:
+            seen.append(entity["id"])
+            yield entity
+
+    stream = FavoritesDiff({}).feed(favorites())
+
+    assert next(stream)["id"] == "1"
+    assert seen == ["1"]
+
+
+def test_snapshot_round_trip():
+    snapshot = {"studios": {}, "performers": {"1": {"hash": "h", "name": "A"}}}
+    save_sync_snapshot(snapshot)
+
+    assert load_sync_snapshot() == snapshot
+
+
+def test_missing_or_corrupt_snapshot_syncs_everything(snapshot_file):
+    assert load_sync_snapshot() == {"studios": {}, "performers": {}}
+
+    snapshot_file.write_text("{not json")
+    assert load_sync_snapshot() == {"studios": {}, "performers": {}}
+
+
+def test_full_sync_ignores_the_snapshot(snapshot_file, monkeypatch):
+    snapshot_file.write_text('{"studios": {"1": {"hash": "h", "name": "A"}}, "performers": {}}')
+    monkeypatch.setattr(sync_favorites, "SYNC_FULL", True)
+
+    assert load_sync_snapshot() == {"studios": {}, "performers": {}}
+
+
+def test_unmatched_favorites_are_retried_on_stashapp_only():
+    pending = performer("1", "Not in StashApp yet")
+    matched = performer("2", "In StashApp")
+    previous = {"1": dict(entry(pending), stashapp=False), "2": entry(matched)}
+    diff = FavoritesDiff(previous)
+
+    assert list(diff.feed(iter([pending, matched]))) == []
+    assert diff.to_sync == []
+    assert diff.stashapp_pending == [pending]